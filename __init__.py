@@ -21,7 +21,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 #
-# Requires: mycroft-pip install fuzzywuzzy
+# Requires: mycroft-pip install rapidfuzz numpy
 #
 
 from adapt.intent import IntentBuilder
@@ -29,20 +29,2322 @@ from adapt.intent import IntentBuilder
 from mycroft.skills.core import MycroftSkill
 from mycroft.util.log import getLogger
 from mycroft.skills.common_play_skill import CommonPlaySkill, CPSMatchLevel
+from mycroft.messagebus.message import Message
 from os.path import expanduser, isabs
 from urllib.parse import unquote
-from fuzzywuzzy import fuzz, process as fuzz_process
+from rapidfuzz import fuzz, process as fuzz_process
+from rapidfuzz.utils import default_process
 
+import copy
+import datetime
+import functools
+import numpy
 import os
 import pathlib
-import random
+import pickle
+import re
+import subprocess
+import sys
+import threading
 import time
+import unicodedata
 import xml.etree.cElementTree as ET
+from array import array
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from .shard_worker import MAX_SHARDS
 
 __author__ = 'dwfalk, gras64, andrewbuis'
 
 logger = getLogger(__name__)
 
+# Bump whenever the layout of TrackIndex or the snapshot dict changes.
+SNAPSHOT_VERSION = 4
+
+# Whether a track can be queued, kept per track in TrackIndex.
+PLAYABLE, RELATIVE, UNSUPPORTED, MISSING = range(4)
+
+
+def _canonical_uri(location):
+    """The file URI to queue for a rhythmdb location, and its status.
+
+    Only absolute file:// locations can be played; for anything else the
+    URI is empty and the status says why.
+    """
+    if not location.startswith('file://'):
+        return '', UNSUPPORTED
+    path = unquote(location[7:])
+    if not isabs(path):
+        return '', RELATIVE
+    return pathlib.Path(path).as_uri(), PLAYABLE
+
+
+def _entry_key(song):
+    """The rhythmdb fields that change when a song is rescanned, played or rated."""
+    return (_int_field(song.get('last-seen')), _int_field(song.get('mtime')),
+            _int_field(song.get('play-count')), _int_field(song.get('last-played')),
+            _float_field(song.get('rating')))
+
+
+def _int_field(text):
+    try:
+        return int(text)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _float_field(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _sizeof(obj, seen=None):
+    """Approximate deep size in bytes of lists, dicts, tuples and scalars."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_sizeof(k, seen) + _sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(_sizeof(item, seen) for item in obj)
+    elif hasattr(obj, '__dict__') and not isinstance(obj, type):
+        size += _sizeof(obj.__dict__, seen)
+    return size
+
+
+# Vocabulary files, in vocab/<lang>, of the words removed from a phrase
+# before matching it against each category and of the keywords looked
+# for in it.
+STRIP_VOCAB = {
+    "playlist": "PlaylistWords.voc",
+    "title": "TitleWords.voc",
+    "artist": "ArtistWords.voc",
+    "album": "AlbumWords.voc",
+    "genre": "GenreWords.voc",
+}
+KEYWORD_VOCAB = {
+    "general_artist": "GeneralArtistKeyword.voc",
+    "on_rhythmbox": "OnRhythmboxKeyword.voc",
+}
+
+
+def _read_vocab(path):
+    """Phrases of a vocabulary file, one per line or separated by |."""
+    phrases = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                phrases.extend(" ".join(p.split()) for p in line.split('|') if p.strip())
+    return phrases
+
+
+class PhraseGrammar(object):
+    """Stop words and keywords of one language, found in a single pass.
+
+    All phrases are compiled into one regular expression that finds, at
+    every word start, the longest phrase beginning there. Every shorter
+    phrase that starts at the same place is a whole-word prefix of it, so
+    the longest phrase of each table at that position is known in
+    advance; ``parse`` only has to keep the non-overlapping ones per
+    table. Phrases match whole words, so "by" is not found in "baby".
+    The last phrase parsed is remembered, as each search asks for it once
+    per category.
+    """
+
+    def __init__(self, strip, keywords):
+        self.strip = strip
+        self.keywords = keywords
+        self._last = None
+        phrases = {p for table in list(strip.values()) + list(keywords.values()) for p in table}
+        ordered = sorted(phrases, key=len, reverse=True)
+        self.pattern = re.compile(r"(?<!\w)(?=(" + "|".join(map(re.escape, ordered)) + r")(?!\w))"
+                                  if ordered else r"(?!)")
+        self.prefixes = {phrase: ({name: len(longest) for name, longest in self._longest(phrase, strip)},
+                                  {name for name, _ in self._longest(phrase, keywords)})
+                         for phrase in ordered}
+
+    @staticmethod
+    def _longest(phrase, tables):
+        for name, table in tables.items():
+            prefixes = [p for p in table if phrase.startswith(p)
+                        and not re.match(r"\w", phrase[len(p):len(p) + 1])]
+            if prefixes:
+                yield name, max(prefixes, key=len)
+
+    @classmethod
+    def load(cls, directory, fallback=None):
+        """Grammar from the vocabulary files in a directory.
+
+        Files missing there are read from ``fallback`` instead, and
+        tables missing from both are left empty.
+        """
+        tables = []
+        for files in (STRIP_VOCAB, KEYWORD_VOCAB):
+            table = {}
+            for name, filename in files.items():
+                table[name] = []
+                for path in (directory, fallback):
+                    if path and os.path.isfile(os.path.join(path, filename)):
+                        table[name] = _read_vocab(os.path.join(path, filename))
+                        break
+            tables.append(table)
+        return cls(*tables)
+
+    def parse(self, phrase):
+        """({category: utterance}, {keyword}) for a phrase.
+
+        Each utterance is the phrase, followed by a space, with the
+        category's stop words taken out and the spaces around them left.
+        """
+        last = self._last
+        if last is not None and last[0] == phrase:
+            return last[1]
+        text = phrase + " "
+        cuts = {name: [] for name in self.strip}
+        found = set()
+        for match in self.pattern.finditer(text):
+            start = match.start()
+            lengths, keywords = self.prefixes[match.group(1)]
+            found.update(keywords)
+            for name, length in lengths.items():
+                spans = cuts[name]
+                if not spans or spans[-1][1] <= start:
+                    spans.append((start, start + length))
+        utterances = {}
+        for name, spans in cuts.items():
+            parts = []
+            end = 0
+            for start, stop in spans:
+                parts.append(text[end:start])
+                end = stop
+            parts.append(text[end:])
+            utterances[name] = "".join(parts)
+        self._last = (phrase, (utterances, found))
+        return utterances, found
+
+
+# Minimum score for a category match to count at all.
+THRESHOLDS = {
+    "playlist": 65,
+    "title": 70,
+    "artist": 70,
+    "album": 70,
+    "genre": 70,
+    "by": 85,
+    "album_by": 85,
+}
+
+
+def _ratio(s1, s2):
+    """fuzz.ratio rounded to an int, as the thresholds were written for."""
+    return int(round(fuzz.ratio(s1, s2)))
+
+
+def _trigrams(text):
+    text = " " + text + " "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class TrigramIndex(object):
+    """Character trigram inverted index over a list of strings.
+
+    ``shortlist`` returns the positions of the strings sharing the most
+    trigrams with a query, in list order, so that only those need to be
+    scored exactly.
+    """
+
+    def __init__(self, strings):
+        self.size = len(strings)
+        postings = {}
+        for i, text in enumerate(strings):
+            for trigram in _trigrams(text):
+                postings.setdefault(trigram, []).append(i)
+        self.postings = {trigram: numpy.array(ids, dtype=numpy.int32)
+                         for trigram, ids in postings.items()}
+
+    def shortlist(self, query, limit):
+        counts = numpy.zeros(self.size, dtype=numpy.int32)
+        for trigram in _trigrams(query):
+            ids = self.postings.get(trigram)
+            if ids is not None:
+                counts[ids] += 1
+        if limit >= self.size:
+            return numpy.arange(self.size)
+        candidates = numpy.argpartition(-counts, limit)[:limit]
+        candidates.sort()
+        return candidates
+
+
+NUMBER_WORDS = ("zero one two three four five six seven eight nine ten eleven twelve "
+                "thirteen fourteen fifteen sixteen seventeen eighteen nineteen").split()
+TENS_WORDS = "_ _ twenty thirty forty fifty sixty seventy eighty ninety".split()
+
+
+def _number_words(n):
+    """A number below 10000 the way it is usually said, years included."""
+    if n < 20:
+        return NUMBER_WORDS[n]
+    if n < 100:
+        return TENS_WORDS[n // 10] + ("" if n % 10 == 0 else " " + NUMBER_WORDS[n % 10])
+    if n < 1000:
+        rest = n % 100
+        return NUMBER_WORDS[n // 100] + " hundred" + ("" if rest == 0 else " " + _number_words(rest))
+    if n < 10000:
+        rest = n % 100
+        if n % 1000 == 0 or 2000 <= n < 2010 or (n // 100) % 10 == 0:
+            rest = n % 1000
+            return NUMBER_WORDS[n // 1000] + " thousand" + ("" if rest == 0 else " " + _number_words(rest))
+        if rest == 0:
+            return _number_words(n // 100) + " hundred"
+        return _number_words(n // 100) + (" oh " if rest < 10 else " ") + _number_words(rest)
+    return None
+
+
+class SpokenForms(object):
+    """Alternate spellings of library names, closer to what STT returns.
+
+    The NORMALISING rules rewrite a name into the one way it would be
+    spoken; the DROPPING rules then each add a form of every form so far
+    with an optional part left out, so a name gets at most four forms.
+    Forms that preprocess to a string already found are left out.
+    ``expand`` adds
+    the forms of a corpus after it, each mapped back to its name, so a
+    spoken "simon and garfunkel" scores 100 against "Simon & Garfunkel". The
+    count and approximate size of the added forms are kept for the log.
+    """
+
+    NORMALISING = ("ampersand", "numbers", "diacritics")
+    DROPPING = ("article", "brackets")
+    RULES = NORMALISING + DROPPING
+    LETTERS = str.maketrans({"ß": "ss", "ø": "o", "Ø": "O", "æ": "ae", "Æ": "AE",
+                             "œ": "oe", "Œ": "OE", "ł": "l", "Ł": "L", "đ": "d", "Đ": "D"})
+    SUFFIX = re.compile(r"\s*(\([^()]*\)|\[[^\[\]]*\])\s*$"
+                        r"|\s+-\s+[^-]*\b(remaster(ed)?|live|version|edit|mix|mono|stereo)\b[^-]*$",
+                        re.IGNORECASE)
+
+    def __init__(self, rules=RULES):
+        unknown = [rule for rule in rules if rule not in self.RULES]
+        if unknown:
+            logger.warning("Unknown spoken form rules ignored: {}".format(", ".join(unknown)))
+        self.normalising = [getattr(self, "_" + rule) for rule in self.NORMALISING if rule in rules]
+        self.dropping = [getattr(self, "_" + rule) for rule in self.DROPPING if rule in rules]
+        self.count = 0
+        self.size = 0
+
+    @classmethod
+    def from_setting(cls, value):
+        """Rules from a comma separated setting, all of them if it is unset."""
+        if value is None:
+            return cls()
+        return cls([rule.strip().lower() for rule in str(value).split(",") if rule.strip()])
+
+    @staticmethod
+    def _ampersand(text):
+        return re.sub(r"\s*&\s*", " and ", text)
+
+    @staticmethod
+    def _numbers(text):
+        return re.sub(r"\b\d+\b", lambda m: _number_words(int(m.group())) or m.group(), text)
+
+    @classmethod
+    def _diacritics(cls, text):
+        text = unicodedata.normalize("NFKD", text.translate(cls.LETTERS))
+        return "".join(c for c in text if not unicodedata.combining(c))
+
+    @staticmethod
+    def _article(text):
+        return re.sub(r"^\s*the\s+", "", text, flags=re.IGNORECASE)
+
+    @classmethod
+    def _brackets(cls, text):
+        while True:
+            stripped = cls.SUFFIX.sub("", text)
+            if stripped == text or not stripped.strip():
+                return text
+            text = stripped
+
+    def forms(self, name):
+        """Processed alternate forms of a name, without the name's own."""
+        spoken = name
+        for rule in self.normalising:
+            spoken = rule(spoken)
+        forms = [spoken]
+        for rule in self.dropping:
+            for form in list(forms):
+                alternate = rule(form)
+                if alternate not in forms and alternate.strip():
+                    forms.append(alternate)
+        seen = {default_process(name)}
+        processed = []
+        for form in forms:
+            form = default_process(form)
+            if form and form not in seen:
+                seen.add(form)
+                processed.append(form)
+        return processed
+
+    def expand(self, names):
+        """(choices, forms): the names, then each alternate form with its name."""
+        choices = list(names)
+        forms = list(names)
+        for name in names:
+            for form in self.forms(name):
+                choices.append(name)
+                forms.append(form)
+                self.count += 1
+                # The form, its slot in the matcher's list and in choices
+                self.size += sys.getsizeof(form) + 16
+        return choices, forms
+
+
+class ByResolver(object):
+    """Matches "<value> by <artist>" utterances one artist at a time.
+
+    The utterance is split at each occurrence of the separator, the
+    artist part is scored against the distinct artists, and the value
+    part only against the catalogues of the ``candidates`` best of them.
+    The two ratios are turned back into matched character counts and
+    combined, with the separator counted as matched, into the ratio the
+    concatenated strings would have had if each part matched only its
+    own counterpart. An exact match still scores 100 and a near miss
+    scores a little below what the whole string would, so the by and
+    album_by thresholds keep their meaning.
+
+    With ``spoken`` forms, artists and catalogues are expanded the way
+    MatchEngine corpora are; the forms of one artist share its catalogue.
+    """
+
+    def __init__(self, catalogue, separator, candidates=5, spoken=None):
+        self.separator = separator
+        self.candidates = candidates
+        expand = spoken.expand if spoken is not None else lambda names: (list(names), list(names))
+        self.artists, forms = expand(list(catalogue))
+        self.processed = [default_process(form) for form in forms]
+        catalogues = {}
+        for artist in catalogue:
+            values, value_forms = expand(catalogue[artist])
+            catalogues[artist] = values, [default_process(form) for form in value_forms]
+        self.values = [catalogues[artist][0] for artist in self.artists]
+        self.processed_values = [catalogues[artist][1] for artist in self.artists]
+        self.lengths = numpy.array([len(artist) for artist in self.processed], dtype=float)
+
+    def _splits(self, query):
+        padded = " " + query + " "
+        splits = []
+        i = padded.find(self.separator)
+        while i >= 0:
+            splits.append((padded[1:i], padded[i + len(self.separator):-1]))
+            i = padded.find(self.separator, i + 1)
+        return splits
+
+    def best(self, query):
+        """Best ((value, artist), score) for a processed utterance."""
+        splits = self._splits(query)
+        if not splits or not self.artists:
+            return None, 0
+        rows = fuzz_process.cdist([artist for _, artist in splits], self.processed,
+                                  scorer=fuzz.ratio, workers=-1)
+        separator = len(self.separator)
+        best, best_score = None, -1
+        for (value, artist), row in zip(splits, rows):
+            limit = min(self.candidates, len(row))
+            candidates = numpy.argpartition(-row, limit - 1)[:limit]
+            candidates.sort()
+            artist_matched = row[candidates] * (len(artist) + self.lengths[candidates]) / 200
+            for candidate, matched in zip(candidates, artist_matched):
+                choices = self.processed_values[candidate]
+                lengths = numpy.fromiter(map(len, choices), dtype=float, count=len(choices))
+                scores = fuzz_process.cdist([value], choices, scorer=fuzz.ratio)[0]
+                matched = scores * (len(value) + lengths) / 200 + matched + separator
+                total = (len(value) + len(artist) + lengths + self.lengths[candidate]
+                         + 2 * separator)
+                combined = numpy.rint(200 * matched / total)
+                i = int(combined.argmax())
+                if combined[i] > best_score:
+                    best = (self.values[candidate][i], self.artists[candidate])
+                    best_score = int(combined[i])
+        return best, best_score
+
+
+class MatchEngine(object):
+    """Fuzzy matching of one phrase against all category corpora at once.
+
+    The corpora are preprocessed once per index. A query maps categories
+    to the utterance each of them should be matched with; every distinct
+    utterance is scored in a single rapidfuzz cdist call against the
+    concatenation of the corpora that use it, and each category then takes
+    the best choice from its own slice of the row. Scores are rounded the
+    way fuzzywuzzy rounded them and ties go to the first choice, so a
+    category gets what extractOne with fuzz.ratio would have returned.
+
+    The corpora named in SHORTLISTED grow with the library. Once one holds
+    more than ``shortlist`` strings it gets a TrigramIndex, and only the
+    ``shortlist`` candidates sharing the most trigrams with the utterance
+    are scored, with the same scorer, instead of the whole corpus.
+
+    Categories with a ByResolver in ``resolvers`` are not scored against
+    a corpus; their choice is a (value, artist) pair.
+
+    ``forms``, when given for a category, holds the strings to match in
+    place of its corpus, position for position; a corpus expanded by
+    SpokenForms repeats a name once per form. An utterance that is
+    exactly one of the preprocessed strings is looked up rather than
+    scored, which gives the same first choice with 100.
+    """
+
+    SHORTLISTED = ("title",)
+
+    def __init__(self, corpora, shortlist=300, resolvers=None, forms=None):
+        self.corpora = corpora
+        self.resolvers = resolvers or {}
+        self.shortlist = shortlist
+        forms = forms or {}
+        self.processed = {category: [default_process(c) for c in forms.get(category, corpus)]
+                          for category, corpus in corpora.items()}
+        self.exact = {}
+        for category, processed in self.processed.items():
+            exact = self.exact[category] = {}
+            for i, text in enumerate(processed):
+                exact.setdefault(text, i)
+        self.trigrams = {category: TrigramIndex(self.processed[category])
+                         for category in self.SHORTLISTED
+                         if len(self.processed.get(category, ())) > shortlist > 0}
+        self._choices = {}
+
+    def _choices_for(self, categories):
+        key = tuple(categories)
+        if key not in self._choices:
+            self._choices[key] = self._concatenate(
+                (category, self.processed[category]) for category in categories)
+        return self._choices[key]
+
+    @staticmethod
+    def _concatenate(corpora):
+        choices = []
+        slices = {}
+        for category, corpus in corpora:
+            start = len(choices)
+            choices.extend(corpus)
+            slices[category] = (start, len(choices))
+        return choices, slices
+
+    def _score(self, query, categories, choices, slices, positions=None):
+        if not query or not choices:
+            row = numpy.zeros(len(choices))
+        else:
+            row = numpy.rint(fuzz_process.cdist([query], choices, scorer=fuzz.ratio,
+                                                workers=-1)[0])
+        results = {}
+        for category in categories:
+            start, end = slices[category]
+            if start == end:
+                results[category] = (None, 0)
+                continue
+            i = int(row[start:end].argmax())
+            if positions is not None:
+                choice = int(positions[category][i])
+            else:
+                choice = i
+            results[category] = (self.corpora[category][choice], int(row[start + i]))
+        return results
+
+    def best(self, queries):
+        """Best (choice, score) per category for {category: utterance}."""
+        by_query = {}
+        results = {}
+        for category, utterance in queries.items():
+            query = default_process(utterance)
+            if category in self.resolvers:
+                results[category] = self.resolvers[category].best(query)
+            elif query and query in self.exact[category]:
+                results[category] = (self.corpora[category][self.exact[category][query]], 100)
+            else:
+                by_query.setdefault(query, []).append(category)
+        for query, categories in by_query.items():
+            full = [c for c in categories if c not in self.trigrams]
+            if full:
+                choices, slices = self._choices_for(full)
+                results.update(self._score(query, full, choices, slices))
+            short = [c for c in categories if c in self.trigrams]
+            if short:
+                positions = {c: self.trigrams[c].shortlist(query, self.shortlist) for c in short}
+                choices, slices = self._concatenate(
+                    (c, [self.processed[c][i] for i in positions[c]]) for c in short)
+                results.update(self._score(query, short, choices, slices, positions))
+        return results
+
+    @contextmanager
+    def search(self, queries):
+        """Scores for {category: utterance}, as a mapping read inside the block."""
+        yield self.best(queries)
+
+
+# Run by path in every ShardPool worker.
+SHARD_WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'shard_worker.py')
+
+
+class ShardPool(object):
+    """Worker processes that each hold one shard of the match corpora.
+
+    Corpora are split into contiguous shards, one per worker, and sent
+    once per library generation. A search takes one slot of the shared
+    cancellation arrays per category and sends the same jobs to every
+    worker. A receiver thread per worker files the replies under their
+    request, so concurrent searches only share the pipes while sending.
+    The skill process already runs threads, so the workers are spawned
+    rather than forked, and run shard_worker.py by path.
+    """
+
+    def __init__(self, workers, block=20000, slots=64):
+        import multiprocessing
+        import runpy
+        context = multiprocessing.get_context('spawn')
+        self.workers = min(workers, MAX_SHARDS)
+        # Held only while writing to the pipes
+        self.lock = threading.Lock()
+        # Guards the request counter, free slots and filed replies
+        self.condition = threading.Condition()
+        self.request = 0
+        self.slots = slots
+        self.free = deque(range(slots))
+        self.replies = {}
+        self.closed = False
+        self.cancelled = context.Array('i', [-1] * slots, lock=False)
+        self.perfect = context.Array('i', [-1] * slots)
+        self.connections = []
+        self.processes = []
+        for shard in range(self.workers):
+            parent, child = context.Pipe()
+            args = (child, shard, self.cancelled, self.perfect, block)
+            process = context.Process(target=runpy.run_path, daemon=True,
+                                      args=(SHARD_WORKER, {'ARGS': args}, '__shard_worker__'))
+            process.start()
+            child.close()
+            self.connections.append(parent)
+            self.processes.append(process)
+        for shard, connection in enumerate(self.connections):
+            threading.Thread(target=self._receive, args=(shard, connection), daemon=True).start()
+
+    def _receive(self, shard, connection):
+        while True:
+            try:
+                request, position, reply = connection.recv()
+            except (EOFError, OSError):
+                break
+            with self.condition:
+                replies = self.replies.get(request)
+                if replies is not None:
+                    replies[shard][position] = reply
+                    self.condition.notify_all()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def bounds(self, size):
+        """(start, end) of each shard of a corpus of ``size`` strings."""
+        step = -(-size // self.workers)
+        return [(min(i * step, size), min((i + 1) * step, size)) for i in range(self.workers)]
+
+    def load(self, generation, corpora):
+        with self.lock:
+            for shard, connection in enumerate(self.connections):
+                connection.send(('load', generation, {
+                    category: corpus[start:end]
+                    for category, corpus in corpora.items()
+                    for start, end in [self.bounds(len(corpus))[shard]]}))
+
+    def submit(self, generation, queries):
+        """Start scoring [(category, query)]; returns (request, jobs).
+
+        Waits for free slots if other searches hold them all. Slots are
+        reused oldest first, so a cancelled job still running rarely
+        shares one with a live search.
+        """
+        if len(queries) > self.slots:
+            raise ValueError("At most {} categories per search".format(self.slots))
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.free) >= len(queries) or self.closed)
+            if self.closed:
+                raise RuntimeError("The match workers have stopped")
+            slots = [self.free.popleft() for _ in queries]
+            self.request = (self.request + 1) % (2 ** 31 // MAX_SHARDS)
+            request = self.request
+            self.replies[request] = [{} for _ in self.connections]
+        jobs = [(slot, category, query) for slot, (category, query) in zip(slots, queries)]
+        with self.lock:
+            for connection in self.connections:
+                connection.send(('score', request, generation, jobs))
+        return request, jobs
+
+    def reply(self, request, shard, position):
+        """A worker's reply to one job, waiting for it; None if the pool closed."""
+        with self.condition:
+            replies = self.replies[request][shard]
+            self.condition.wait_for(lambda: position in replies or self.closed)
+            return replies.get(position)
+
+    def release(self, request, jobs):
+        """Cancel the unfinished jobs of a search and free its slots."""
+        for slot, _, _ in jobs:
+            self.cancelled[slot] = request
+        with self.condition:
+            del self.replies[request]
+            self.free.extend(slot for slot, _, _ in jobs)
+            self.condition.notify_all()
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections:
+                try:
+                    connection.send(None)
+                except OSError:
+                    pass
+            for process in self.processes:
+                process.join(1)
+                if process.is_alive():
+                    process.terminate()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class PendingScores(object):
+    """Scores of a sharded search, combined per category when first read.
+
+    Reading a category waits for all of its shards; ``close`` cancels the
+    categories nobody read, so a caller that stops early stops the
+    workers as well.
+    """
+
+    def __init__(self, engine, pool, request, jobs, immediate):
+        self.engine = engine
+        self.pool = pool
+        self.request = request
+        self.jobs = jobs
+        self.results = immediate
+
+    def __contains__(self, category):
+        return category in self.results or any(job[1] == category for job in self.jobs)
+
+    def __getitem__(self, category):
+        if category not in self.results:
+            position = [job[1] for job in self.jobs].index(category)
+            self.results[category] = self._combine(category, position)
+        return self.results[category]
+
+    def keys(self):
+        return list(self.results) + [job[1] for job in self.jobs if job[1] not in self.results]
+
+    def _combine(self, category, position):
+        bounds = self.pool.bounds(len(self.engine.corpora[category]))
+        best, best_score = None, -1
+        for shard, (start, end) in enumerate(bounds):
+            reply = self.pool.reply(self.request, shard, position) if start < end else None
+            if reply is not None and reply[1] > best_score:
+                best, best_score = start + reply[0], reply[1]
+            if best_score == 100:
+                break
+        if best is None:
+            return None, 0
+        return self.engine.corpora[category][best], best_score
+
+    def close(self):
+        self.pool.release(self.request, self.jobs)
+
+
+class ShardedMatchEngine(MatchEngine):
+    """MatchEngine that scores the corpora on a ShardPool.
+
+    Every category is scored in full, with no trigram shortlist, and the
+    shard results are combined the way a single row would be: rounded
+    scores, ties to the first choice. Results are therefore identical to
+    an in-process MatchEngine with a shortlist of 0. Categories are
+    scored in the order the query lists them, so a caller that reads the
+    search results in that order and stops at the first decisive one
+    cancels the work on the rest. Within a category only a perfect score
+    ends the scan early; see score_shard in shard_worker.py. Resolver
+    categories and exact hits are cheap and are answered in this process.
+    """
+
+    def __init__(self, corpora, pool, generation, resolvers=None, forms=None):
+        super(ShardedMatchEngine, self).__init__(corpora, shortlist=0, resolvers=resolvers,
+                                                 forms=forms)
+        self.pool = pool
+        self.generation = generation
+        pool.load(generation, self.processed)
+
+    def best(self, queries):
+        with self.search(queries) as scores:
+            return {category: scores[category] for category in queries}
+
+    @contextmanager
+    def search(self, queries):
+        jobs = []
+        immediate = {}
+        for category, utterance in queries.items():
+            query = default_process(utterance)
+            if category in self.resolvers:
+                immediate[category] = self.resolvers[category].best(query)
+                continue
+            corpus = self.corpora[category]
+            if not corpus:
+                immediate[category] = (None, 0)
+            elif query and query in self.exact[category]:
+                immediate[category] = (corpus[self.exact[category][query]], 100)
+            elif not query:
+                immediate[category] = (corpus[0], 0)
+            else:
+                jobs.append((category, query))
+        if not jobs:
+            yield immediate
+            return
+        request, jobs = self.pool.submit(self.generation, jobs)
+        scores = PendingScores(self, self.pool, request, jobs, immediate)
+        try:
+            yield scores
+        finally:
+            scores.close()
+
+
+class _Span(object):
+
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.record(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Metrics(object):
+    """Stage timings and counters for the matching and playback pipeline.
+
+    ``span(stage)`` times a block into a rolling window of the last
+    ``window`` durations of that stage, and into the request running on
+    the current thread, if any. ``count`` bumps a per-request counter such
+    as the number of processes started. When disabled every call returns
+    straight away and ``span`` hands out one shared no-op context manager.
+
+    Work a request hands to another thread is attributed to it with
+    ``hold`` and ``resume``, or given up with ``release``; the request is
+    finished, and passed to ``listener``, once it has ended and all of
+    that work has run or been given up.
+    """
+
+    def __init__(self, enabled=False, window=500):
+        self.enabled = enabled
+        self.window = window
+        self.histograms = {}
+        self.totals = {}
+        self.listener = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def span(self, stage):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, stage)
+
+    def record(self, stage, seconds):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms.setdefault(stage, deque(maxlen=self.window))
+        histogram.append(seconds)
+        request = getattr(self._local, 'request', None)
+        if request is not None:
+            with self._lock:
+                request['stages'][stage] = request['stages'].get(stage, 0) + seconds * 1000
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        self.totals[name] = self.totals.get(name, 0) + n
+        request = getattr(self._local, 'request', None)
+        if request is not None:
+            with self._lock:
+                request['counts'][name] = request['counts'].get(name, 0) + n
+
+    def begin(self, name):
+        if self.enabled:
+            self._local.request = {'request': name, 'stages': {}, 'counts': {},
+                                   'start': time.perf_counter(), 'open': True, 'held': 0}
+
+    def current(self):
+        """The request running on this thread, or None."""
+        return getattr(self._local, 'request', None)
+
+    def hold(self, request):
+        """Keep a request from finishing until a matching ``resume`` has run."""
+        if request is not None:
+            with self._lock:
+                request['held'] += 1
+
+    @contextmanager
+    def resume(self, request):
+        """Attribute the block, on any thread, to a request that was held."""
+        if request is None:
+            yield
+            return
+        previous = getattr(self._local, 'request', None)
+        self._local.request = request
+        try:
+            yield
+        finally:
+            self._local.request = previous
+            self.release(request)
+
+    def release(self, request):
+        """Drop a ``hold``, finishing the request if nothing else holds it."""
+        if request is None:
+            return
+        with self._lock:
+            request['held'] -= 1
+        self._finish(request)
+
+    def end(self):
+        """End the current thread's request.
+
+        Returns its record, also passed to ``listener``, if nothing holds
+        it any more, or None if held work will finish it later.
+        """
+        request = getattr(self._local, 'request', None)
+        self._local.request = None
+        if request is None:
+            return None
+        with self._lock:
+            request['open'] = False
+        return self._finish(request)
+
+    def _finish(self, request):
+        with self._lock:
+            if request['open'] or request['held'] or 'start' not in request:
+                return None
+            del request['open'], request['held']
+            request['total_ms'] = (time.perf_counter() - request.pop('start')) * 1000
+        if self.listener is not None:
+            self.listener(request)
+        return request
+
+    def summary(self):
+        stages = {}
+        for stage, histogram in list(self.histograms.items()):
+            samples = sorted(histogram)
+            if not samples:
+                continue
+            stages[stage] = {
+                'n': len(samples),
+                'p50_ms': samples[len(samples) // 2] * 1000,
+                'p90_ms': samples[int(len(samples) * 0.9)] * 1000,
+                'p99_ms': samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000,
+                'max_ms': samples[-1] * 1000,
+            }
+        return {'enabled': self.enabled, 'stages': stages, 'counts': dict(self.totals)}
+
+
+def _timed(stage):
+    """Time the decorated skill method as a stage of the current request."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.span(stage):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _is_true(value):
+    """Interpret a checkbox setting, which may arrive as a string."""
+    return str(value).lower() in ('true', '1', 'yes')
+
+
+def _normalize_phrase(phrase):
+    return " ".join(phrase.lower().split())
+
+
+class QueryCache(object):
+    """Bounded LRU cache of resolved queries.
+
+    Entries belong to the index generation they were resolved against and
+    the whole cache is dropped the first time it is used with a newer one.
+    """
+
+    MISSING = object()
+
+    def __init__(self, size=256):
+        self.size = size
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def _check_generation(self, generation):
+        if generation != self.generation:
+            self._entries.clear()
+            self.generation = generation
+
+    def get(self, key, generation):
+        self._check_generation(generation)
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return self.MISSING
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, generation):
+        self._check_generation(generation)
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+            "size": self.size,
+            "generation": self.generation,
+        }
+
+
+SONG_FIELDS = ('title', 'artist', 'album', 'genre', 'track-number', 'location',
+               'last-seen', 'mtime', 'duration', 'play-count', 'first-seen',
+               'last-played', 'date', 'rating')
+
+
+def _iter_songs(path):
+    """Stream the song entries of a rhythmdb.xml file.
+
+    Yields one dict per song holding only SONG_FIELDS. Elements are
+    cleared as soon as they have been read, so memory stays proportional
+    to the extracted fields instead of the whole document, and the
+    children of non-song entries (podcasts, radio, ignored files) are
+    never collected.
+    """
+    context = ET.iterparse(path, events=('start', 'end'))
+    _, root = next(context)
+    song = None
+    in_entry = False
+    for event, elem in context:
+        if elem.tag == 'entry':
+            if event == 'start':
+                in_entry = True
+                song = {} if elem.get('type') == 'song' else None
+            else:
+                in_entry = False
+                if song is not None:
+                    yield song
+                song = None
+                root.clear()
+        elif event == 'end' and in_entry and song is not None and elem.tag in SONG_FIELDS:
+            song[elem.tag] = elem.text or ''
+
+
+def _file_fingerprint(path):
+    """(mtime, size) of a file, or None if it cannot be read."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def _iter_playlists(path):
+    """Stream the <playlist> elements of a playlists.xml file.
+
+    Each element is complete when it is yielded and is cleared as soon as
+    the next one is asked for.
+    """
+    context = ET.iterparse(path, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event == 'end' and elem.tag == 'playlist':
+            yield elem
+            root.clear()
+
+
+def _pair(first, second):
+    return first << 32 | second
+
+
+def _ids(postings):
+    """Track ids of a postings value, which is a bare id for a single track."""
+    return (postings,) if isinstance(postings, int) else postings
+
+
+class StringTable(object):
+    """Interned strings with dense integer ids."""
+
+    def __init__(self, strings=()):
+        self.strings = []
+        self.ids = {}
+        for string in strings:
+            self.intern(string)
+
+    def intern(self, string):
+        string_id = self.ids.get(string)
+        if string_id is None:
+            string_id = len(self.strings)
+            string = sys.intern(string)
+            self.strings.append(string)
+            self.ids[string] = string_id
+        return string_id
+
+    def copy(self):
+        table = StringTable()
+        table.strings = self.strings[:]
+        table.ids = dict(self.ids)
+        return table
+
+
+class TrackIndex(object):
+    """Columnar in-memory index of the songs in rhythmdb.xml.
+
+    Titles, artists, albums, genres, locations and the canonical URIs of
+    the locations are interned once in a StringTable each, and every
+    track is a row across per-field arrays of string ids and numbers. Postings map a title, artist, album or genre
+    id, or an (artist, title) / (artist, album) pair of ids packed into one
+    int, to the tracks holding it: a bare track id for a single track, an
+    array of them otherwise. "X by Y" lookups need no joined strings.
+
+    Songs are keyed by location; ``update`` compares the rhythmdb
+    ``last-seen``, ``mtime``, ``play-count``, ``last-played`` and
+    ``rating`` of each entry with the ones already indexed so only added,
+    removed or changed songs are touched. Removed rows are marked dead so
+    track ids stay stable, and the store is rebuilt once more than half of
+    it is dead.
+
+    The ``status`` column tells whether a track can be queued: its URI is
+    canonicalized when it is added, and FileCheck marks the tracks whose
+    files have gone missing.
+    """
+
+    STRINGS = ('title', 'artist', 'album', 'genre', 'location', 'uri')
+    # Numeric columns and the rhythmdb elements they are read from.
+    NUMBERS = {'track_number': 'track-number', 'duration': 'duration',
+               'play_count': 'play-count', 'first_seen': 'first-seen',
+               'last_played': 'last-played', 'last_seen': 'last-seen',
+               'mtime': 'mtime', 'date': 'date'}
+    REALS = {'rating': 'rating'}
+    POSTINGS = ('title', 'artist', 'album', 'genre', 'by', 'album_by')
+
+    def __init__(self):
+        self.strings = {field: StringTable() for field in self.STRINGS}
+        self.columns = {field: array('i') for field in self.STRINGS}
+        self.columns.update({field: array('q') for field in self.NUMBERS})
+        self.columns.update({field: array('d') for field in self.REALS})
+        self.columns['status'] = array('b')
+        self.alive = bytearray()
+        self.live = 0
+        self.location_tracks = array('i')
+        self.postings = {field: {} for field in self.POSTINGS}
+
+    def __len__(self):
+        return self.live
+
+    def copy(self):
+        """A copy that can be updated without affecting this index."""
+        index = TrackIndex.__new__(TrackIndex)
+        index.strings = {field: table.copy() for field, table in self.strings.items()}
+        index.columns = {field: column[:] for field, column in self.columns.items()}
+        index.alive = bytearray(self.alive)
+        index.live = self.live
+        index.location_tracks = self.location_tracks[:]
+        index.postings = {field: {key: ids if isinstance(ids, int) else ids[:]
+                                  for key, ids in postings.items()}
+                          for field, postings in self.postings.items()}
+        return index
+
+    def to_snapshot(self):
+        return {
+            'strings': {field: table.strings for field, table in self.strings.items()},
+            'columns': self.columns,
+            'alive': self.alive,
+            'live': self.live,
+            'location_tracks': self.location_tracks,
+            'postings': self.postings,
+        }
+
+    @classmethod
+    def from_snapshot(cls, state):
+        index = cls()
+        index.strings = {field: StringTable(strings) for field, strings in state['strings'].items()}
+        index.columns = state['columns']
+        index.alive = state['alive']
+        index.live = state['live']
+        index.location_tracks = state['location_tracks']
+        index.postings = state['postings']
+        return index
+
+    def _keys(self, track_id):
+        columns = self.columns
+        artist = columns['artist'][track_id]
+        return (('title', columns['title'][track_id]),
+                ('artist', artist),
+                ('album', columns['album'][track_id]),
+                ('genre', columns['genre'][track_id]),
+                ('by', _pair(artist, columns['title'][track_id])),
+                ('album_by', _pair(artist, columns['album'][track_id])))
+
+    def _entry_key(self, track_id):
+        """The indexed counterpart of _entry_key(song)."""
+        columns = self.columns
+        return (columns['last_seen'][track_id], columns['mtime'][track_id],
+                columns['play_count'][track_id], columns['last_played'][track_id],
+                columns['rating'][track_id])
+
+    def add_song(self, song):
+        track_id = len(self.alive)
+        columns = self.columns
+        for field in ('title', 'artist', 'album', 'genre'):
+            columns[field].append(self.strings[field].intern(song.get(field, '').lower()))
+        location = song.get('location', '')
+        location_id = self.strings['location'].intern(location)
+        columns['location'].append(location_id)
+        uri, status = _canonical_uri(location)
+        columns['uri'].append(self.strings['uri'].intern(uri))
+        columns['status'].append(status)
+        for field, tag in self.NUMBERS.items():
+            columns[field].append(_int_field(song.get(tag)))
+        for field, tag in self.REALS.items():
+            columns[field].append(_float_field(song.get(tag)))
+        self.alive.append(1)
+        self.live += 1
+        if location_id == len(self.location_tracks):
+            self.location_tracks.append(track_id)
+        else:
+            self.location_tracks[location_id] = track_id
+        for field, key in self._keys(track_id):
+            postings = self.postings[field]
+            ids = postings.get(key)
+            if ids is None:
+                postings[key] = track_id
+            elif isinstance(ids, int):
+                postings[key] = array('i', (ids, track_id))
+            else:
+                ids.append(track_id)
+        return track_id
+
+    def remove(self, track_ids):
+        track_ids = set(track_ids)
+        touched = set()
+        for track_id in track_ids:
+            self.alive[track_id] = 0
+            self.live -= 1
+            location_id = self.columns['location'][track_id]
+            # A changed song's new row may already hold its location
+            if self.location_tracks[location_id] == track_id:
+                self.location_tracks[location_id] = -1
+            touched.update(self._keys(track_id))
+        for field, key in touched:
+            postings = self.postings[field]
+            ids = [i for i in _ids(postings[key]) if i not in track_ids]
+            if len(ids) > 1:
+                postings[key] = array('i', ids)
+            elif ids:
+                postings[key] = ids[0]
+            else:
+                del postings[key]
+
+    def update(self, songs):
+        """Apply the difference between the index and a song stream.
+
+        New and changed songs are added as they stream in, so only track
+        ids are kept while reading; the rows they replace and the tracks
+        missing from the stream are removed at the end. A location seen
+        earlier in the same stream is skipped. Returns the number of
+        added, changed and removed songs.
+        """
+        locations = self.strings['location'].ids
+        seen = set()
+        stale = []
+        added = 0
+        for song in songs:
+            location_id = locations.get(song.get('location', ''))
+            track_id = -1 if location_id is None else self.location_tracks[location_id]
+            if track_id < 0:
+                added += 1
+            elif track_id in seen:
+                # Only the first entry of a location counts
+                continue
+            elif self._entry_key(track_id) == _entry_key(song):
+                seen.add(track_id)
+                continue
+            else:
+                stale.append(track_id)
+            seen.add(self.add_song(song))
+        changed = len(stale)
+        for track_id in self.location_tracks:
+            if track_id >= 0 and track_id not in seen:
+                stale.append(track_id)
+        self.remove(stale)
+        if self.live * 2 < len(self.alive):
+            self.compact()
+        return added, changed, len(stale) - changed
+
+    def compact(self):
+        """Drop dead rows and unused strings, renumbering the tracks."""
+        rows = list(self._songs())
+        self.__init__()
+        for song in rows:
+            self.add_song(song)
+
+    def _songs(self):
+        for track_id in self.track_ids():
+            song = {field: self.string(field, track_id) for field in self.STRINGS}
+            for field, tag in list(self.NUMBERS.items()) + list(self.REALS.items()):
+                song[tag] = self.columns[field][track_id]
+            yield song
+
+    def track_ids(self):
+        return [i for i, alive in enumerate(self.alive) if alive]
+
+    def string(self, field, track_id):
+        return self.strings[field].strings[self.columns[field][track_id]]
+
+    def names(self, field):
+        """Distinct values of a field among the indexed tracks."""
+        strings = self.strings[field].strings
+        return [strings[key] for key in self.postings[field]]
+
+    def pairs(self, field, second):
+        """Distinct (artist, title) or (artist, album) pairs."""
+        artists = self.strings['artist'].strings
+        strings = self.strings[second].strings
+        return [(artists[key >> 32], strings[key & 0xffffffff]) for key in self.postings[field]]
+
+    def catalogue(self, field, second):
+        """Distinct titles or albums of each artist, as {artist: [value]}."""
+        catalogue = {}
+        for artist, value in self.pairs(field, second):
+            catalogue.setdefault(artist, []).append(value)
+        return catalogue
+
+    def items(self, field):
+        strings = self.strings[field].strings
+        for key, ids in self.postings[field].items():
+            yield strings[key], _ids(ids)
+
+    def lookup(self, field, value):
+        """Track ids for a title, artist, album or genre string."""
+        key = self.strings[field].ids.get(value)
+        return list(_ids(self.postings[field].get(key, ())))
+
+    def lookup_pair(self, field, artist, value):
+        """Track ids for an (artist, title) or (artist, album) pair."""
+        second = 'title' if field == 'by' else 'album'
+        artist_id = self.strings['artist'].ids.get(artist)
+        value_id = self.strings[second].ids.get(value)
+        if artist_id is None or value_id is None:
+            return []
+        return list(_ids(self.postings[field].get(_pair(artist_id, value_id), ())))
+
+    def track_for_location(self, location):
+        """Track id of a rhythmdb location, or -1 if it is not indexed."""
+        location_id = self.strings['location'].ids.get(location)
+        return -1 if location_id is None else self.location_tracks[location_id]
+
+    def track_number(self, track_id):
+        return self.columns['track_number'][track_id]
+
+    def uri(self, track_id):
+        """The canonical URI of a track, or None if it cannot be queued."""
+        if self.columns['status'][track_id] != PLAYABLE:
+            return None
+        return self.string('uri', track_id)
+
+    def uris(self, track_ids):
+        """URIs for the given tracks, skipping the ones that cannot be queued."""
+        uris = []
+        for track_id in track_ids:
+            uri = self.uri(track_id)
+            if uri is not None:
+                uris.append(uri)
+        return uris
+
+    def memory_usage(self):
+        """Approximate bytes held by the store."""
+        size = sum(_sizeof(table.strings) + sys.getsizeof(table.ids)
+                   for table in self.strings.values())
+        size += sum(sys.getsizeof(column) for column in self.columns.values())
+        size += sys.getsizeof(self.alive) + sys.getsizeof(self.location_tracks)
+        for postings in self.postings.values():
+            size += sys.getsizeof(postings)
+            size += sum(sys.getsizeof(key) + sys.getsizeof(ids) for key, ids in postings.items())
+        return size
+
+
+def _parse_query(conjunction):
+    """A serialized Rhythmbox query as a list of alternatives.
+
+    Criteria between <disjunction/> markers must all hold and any of the
+    alternatives may; a <subquery> nests another list. Criteria are kept
+    as (operator, property, value) so the result can be pickled.
+    """
+    alternatives = [[]]
+    for elem in conjunction:
+        if elem.tag == 'disjunction':
+            alternatives.append([])
+        elif elem.tag == 'subquery':
+            inner = elem.find('conjunction')
+            alternatives[-1].append(('subquery', None, [[]] if inner is None else _parse_query(inner)))
+        else:
+            alternatives[-1].append((elem.tag, elem.get('prop', ''), elem.text or ''))
+    return alternatives
+
+
+# Rhythmbox query properties held in TrackIndex columns.
+QUERY_STRINGS = {'title': 'title', 'artist': 'artist', 'album': 'album',
+                 'genre': 'genre', 'location': 'location'}
+QUERY_NUMBERS = {'track-number': 'track_number', 'duration': 'duration',
+                 'play-count': 'play_count', 'first-seen': 'first_seen',
+                 'last-played': 'last_played', 'last-seen': 'last_seen',
+                 'mtime': 'mtime', 'date': 'date', 'rating': 'rating'}
+
+STRING_TESTS = {
+    'equals': lambda string, value: string == value,
+    'not-equal': lambda string, value: string != value,
+    'like': lambda string, value: value in string,
+    'not-like': lambda string, value: value not in string,
+    'prefix': lambda string, value: string.startswith(value),
+    'suffix': lambda string, value: string.endswith(value),
+}
+
+# Rhythmbox's "greater" and "less" include the bound.
+NUMBER_TESTS = {
+    'equals': lambda number, value, now: number == value,
+    'not-equal': lambda number, value, now: number != value,
+    'greater': lambda number, value, now: number >= value,
+    'less': lambda number, value, now: number <= value,
+    'current-time-within': lambda number, value, now: number >= now - value,
+    'current-time-not-within': lambda number, value, now: number < now - value,
+}
+
+
+def _year_bounds(julian_day):
+    """First days of the year holding a Rhythmbox date and of the next one."""
+    year = datetime.date.fromordinal(max(1, int(julian_day))).year
+    return (datetime.date(year, 1, 1).toordinal(),
+            datetime.date(min(year + 1, datetime.MAXYEAR), 1, 1).toordinal())
+
+
+def _compile_query(alternatives, index):
+    """Compile a parsed query into a ``predicate(track_id, now)``."""
+    compiled = [[_compile_criterion(criterion, index) for criterion in criteria]
+                for criteria in alternatives]
+
+    def predicate(track_id, now):
+        return any(all(test(track_id, now) for test in tests) for tests in compiled)
+    return predicate
+
+
+def _compile_criterion(criterion, index):
+    op, prop, value = criterion
+    if op == 'subquery':
+        return _compile_query(value, index)
+    for suffix in ('-folded', '-sort-key'):
+        if prop.endswith(suffix):
+            prop = prop[:-len(suffix)]
+    if prop == 'type':
+        # Only songs are indexed
+        matches = (op == 'equals') == (value == 'song')
+        return lambda track_id, now: matches
+    if prop in QUERY_STRINGS and op in STRING_TESTS:
+        field = QUERY_STRINGS[prop]
+        if field != 'location':
+            value = value.lower()
+        test = STRING_TESTS[op]
+        column = index.columns[field]
+        # Test every distinct string once; tracks then only need a lookup
+        string_ids = frozenset(i for i, string in enumerate(index.strings[field].strings)
+                               if test(string, value))
+        return lambda track_id, now: column[track_id] in string_ids
+    if prop in QUERY_NUMBERS:
+        column = index.columns[QUERY_NUMBERS[prop]]
+        if op.startswith('year-') and prop == 'date':
+            first, last = _year_bounds(_float_field(value))
+            if op == 'year-equals':
+                return lambda track_id, now: first <= column[track_id] < last
+            if op == 'year-not-equal':
+                return lambda track_id, now: not first <= column[track_id] < last
+            if op == 'year-greater':
+                return lambda track_id, now: column[track_id] >= first
+            if op == 'year-less':
+                return lambda track_id, now: 0 < column[track_id] < last
+        elif op in NUMBER_TESTS:
+            test = NUMBER_TESTS[op]
+            value = _float_field(value)
+            return lambda track_id, now: test(column[track_id], value, now)
+    logger.info("Unsupported automatic playlist criterion: {} {} {}".format(op, prop, value))
+    return lambda track_id, now: False
+
+
+# Rhythmbox sort-key names of the columns automatic playlists can be sorted by.
+SORT_KEYS = {'Track': 'track_number', 'Title': 'title', 'Artist': 'artist',
+             'Album': 'album', 'Genre': 'genre', 'Location': 'location',
+             'Duration': 'duration', 'Rating': 'rating', 'PlayCount': 'play_count',
+             'LastPlayed': 'last_played', 'FirstSeen': 'first_seen',
+             'Date': 'date', 'Year': 'date'}
+
+
+class AutomaticPlaylist(object):
+    """A query-based playlist compiled against one TrackIndex.
+
+    ``tracks`` evaluates the query over the index in memory, then applies
+    the playlist's sort order and its count and time limits. Size limits
+    are ignored since file sizes are not indexed.
+    """
+
+    def __init__(self, definition, index):
+        self.index = index
+        self.predicate = _compile_query(definition['query'], index)
+        self.sort_key = SORT_KEYS.get(definition['sort_key'])
+        self.descending = definition['descending']
+        self.limit_count = definition['limit_count']
+        self.limit_time = definition['limit_time']
+
+    def tracks(self, now=None):
+        now = time.time() if now is None else now
+        index = self.index
+        track_ids = [i for i in index.track_ids() if self.predicate(i, now)]
+        if self.sort_key in TrackIndex.STRINGS:
+            track_ids.sort(key=lambda i: index.string(self.sort_key, i), reverse=self.descending)
+        elif self.sort_key is not None:
+            track_ids.sort(key=index.columns[self.sort_key].__getitem__, reverse=self.descending)
+        if self.limit_count:
+            track_ids = track_ids[:self.limit_count]
+        if self.limit_time:
+            durations = index.columns['duration']
+            total = 0
+            for n, track_id in enumerate(track_ids):
+                total += durations[track_id]
+                if total > self.limit_time:
+                    track_ids = track_ids[:n]
+                    break
+        return track_ids
+
+
+class PlaylistIndex(object):
+    """The playlists of playlists.xml, resolved against a TrackIndex.
+
+    Static playlists (and the play queue) are stored as ordered arrays of
+    track ids. Automatic playlists keep their parsed query, sort order and
+    limits, and are compiled by the Library into AutomaticPlaylist objects.
+    Track ids change whenever the TrackIndex does, so a PlaylistIndex is
+    rebuilt along with it.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.static = {}
+        self.automatic = {}
+
+    @classmethod
+    def parse(cls, path, index):
+        playlists = cls()
+        for elem in _iter_playlists(path):
+            name = elem.get('name')
+            playlists.names.append(name)
+            if elem.get('type') == 'automatic':
+                conjunction = elem.find('conjunction')
+                playlists.automatic.setdefault(name, {
+                    'query': [[]] if conjunction is None else _parse_query(conjunction),
+                    'sort_key': elem.get('sort-key'),
+                    'descending': elem.get('sort-direction') == '1',
+                    'limit_count': _int_field(elem.get('limit-count')),
+                    'limit_time': _int_field(elem.get('limit-time')),
+                })
+            elif not playlists.static.get(name):
+                track_ids = (index.track_for_location(location.text or '')
+                             for location in elem.iter('location'))
+                playlists.static[name] = array('i', (i for i in track_ids if i >= 0))
+        return playlists
+
+    def to_snapshot(self):
+        return {'names': self.names, 'static': self.static, 'automatic': self.automatic}
+
+    @classmethod
+    def from_snapshot(cls, state):
+        playlists = cls()
+        playlists.names = state['names']
+        playlists.static = state['static']
+        playlists.automatic = state['automatic']
+        return playlists
+
+    def memory_usage(self):
+        return (_sizeof(self.names) + _sizeof(self.automatic)
+                + sum(sys.getsizeof(ids) for ids in self.static.values()))
+
+
+class FileCheck(object):
+    """Marks the tracks of a TrackIndex whose files have gone missing.
+
+    Runs once over the index on a daemon thread, calling ``os.stat`` for
+    ``batch`` playable or missing tracks at a time and sleeping between
+    batches so no more than ``rate`` files are checked per second. A
+    missing track becomes MISSING and one whose file is back becomes
+    PLAYABLE again, so queues skip missing files without touching the
+    filesystem themselves.
+    """
+
+    def __init__(self, index, rate=200, batch=50):
+        self.index = index
+        self.rate = rate
+        self.batch = batch
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        index = self.index
+        status = index.columns['status']
+        start = time.time()
+        track_ids = [i for i in index.track_ids() if status[i] in (PLAYABLE, MISSING)]
+        missing = 0
+        for i in range(0, len(track_ids), self.batch):
+            batch_start = time.time()
+            for track_id in track_ids[i:i + self.batch]:
+                exists = os.path.exists(unquote(index.string('uri', track_id)[7:]))
+                status[track_id] = PLAYABLE if exists else MISSING
+                missing += not exists
+            if self.cancelled.wait(max(0, self.batch / self.rate - (time.time() - batch_start))):
+                return
+        logger.info("File check: {} of {} tracks missing, took {:.0f}s".format(
+            missing, len(track_ids), time.time() - start))
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+class FileWatcher(object):
+    """Calls ``callback`` once files settle after being changed.
+
+    Watches the directories holding ``paths`` with inotify, so that both
+    writes in place and Rhythmbox's write-to-a-temporary-file-then-rename
+    saves are seen. Bursts of events are debounced: the callback runs
+    ``debounce`` seconds after the last event for one of the paths.
+    Needs the inotify_simple package; creating a watcher raises if it or
+    inotify is unavailable.
+    """
+
+    def __init__(self, paths, callback, debounce=2.0):
+        from inotify_simple import INotify, flags
+        self.callback = callback
+        self.debounce = debounce
+        self.names = {}
+        self.inotify = INotify()
+        mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.DELETE
+        for directory in {os.path.dirname(path) for path in paths}:
+            wd = self.inotify.add_watch(directory, mask)
+            self.names[wd] = {os.path.basename(p) for p in paths if os.path.dirname(p) == directory}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        deadline = None
+        while not self.stopped.is_set():
+            timeout = 1.0 if deadline is None else max(0, deadline - time.time())
+            for event in self.inotify.read(timeout=int(timeout * 1000)):
+                if event.name in self.names.get(event.wd, ()):
+                    deadline = time.time() + self.debounce
+            if deadline is not None and time.time() >= deadline and not self.stopped.is_set():
+                deadline = None
+                try:
+                    self.callback()
+                except Exception:
+                    logger.exception("File change handler failed")
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.inotify.close()
+
+
+class QueueFeeder(object):
+    """Adds the rest of a selection to the play queue on a worker thread.
+
+    ``cancel`` stops the feed and waits for the chunk in flight, so a
+    queue cleared afterwards stays empty.
+    """
+
+    def __init__(self, player, uris, chunk_size=200):
+        self.player = player
+        self.uris = uris
+        self.chunk_size = chunk_size
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        start = time.time()
+        for i in range(0, len(self.uris), self.chunk_size):
+            if self.cancelled.is_set():
+                return
+            self.player.enqueue(self.uris[i:i + self.chunk_size], self.chunk_size)
+        logger.info("Fed {} tracks to the play queue in {:.2f}s".format(
+            len(self.uris), time.time() - start))
+
+    def cancel(self):
+        self.cancelled.set()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+
+
+class QueueWindow(object):
+    """Keeps only the next ``size`` tracks of a selection in the play queue.
+
+    The selection stays in the skill as an array of track ids and a
+    cursor into it, and Rhythmbox only ever holds the window. When the
+    player reports a track change, the tracks played from the window are
+    dropped and a worker thread tops it up again from the cursor.
+    """
+
+    def __init__(self, player, index, track_ids, size=50):
+        self.player = player
+        self.index = index
+        self.track_ids = array('i', track_ids)
+        self.cursor = 0
+        self.size = size
+        self.pending = deque()
+        self.current = None
+        self.changed = threading.Event()
+        self.cancelled = threading.Event()
+        self.thread = None
+
+    def _take(self, count):
+        uris = []
+        while len(uris) < count and self.cursor < len(self.track_ids):
+            uri = self.index.uri(self.track_ids[self.cursor])
+            self.cursor += 1
+            if uri is not None:
+                uris.append(uri)
+        return uris
+
+    def _enqueue(self, uris):
+        self.player.enqueue(uris, len(uris))
+        self.pending.extend(unquote(uri) for uri in uris)
+
+    def start(self):
+        """Queue the first track and start feeding; False if there is none."""
+        first = self._take(1)
+        if not first:
+            return False
+        self._enqueue(first)
+        self.player.add_track_listener(self._track_changed)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self.changed.set()
+        return True
+
+    def _track_changed(self, uri):
+        self.current = unquote(uri)
+        self.changed.set()
+
+    def _run(self):
+        while True:
+            self.changed.wait()
+            self.changed.clear()
+            if self.cancelled.is_set():
+                return
+            if self.current in self.pending:
+                while self.pending.popleft() != self.current:
+                    pass
+            uris = self._take(self.size - len(self.pending))
+            if uris:
+                self._enqueue(uris)
+            elif not self.pending:
+                self.player.remove_track_listener(self._track_changed)
+                return
+
+    def cancel(self):
+        self.cancelled.set()
+        self.changed.set()
+        self.player.remove_track_listener(self._track_changed)
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+
+class ShuffleEngine(object):
+    """Shuffled orders for selections of tracks.
+
+    A weight per track is computed once per Library, from its rating (an
+    unrated track counts as 2.5 stars) and its play count. A selection is
+    then ordered in one pass of numpy operations and a sort:
+
+    - ``random``: every order is equally likely, as random.shuffle did.
+    - ``weighted``: Efraimidis-Spirakis keys, an exponential variate over
+      the weight per track, so liked and often played tracks tend to come
+      first.
+    - ``recent``: weighted, with tracks played within the last few days
+      weighed down until the penalty wears off.
+    - ``spread``: weighted within each artist, then every artist's tracks
+      are spaced evenly over the whole order, starting at a random offset,
+      so the same artist rarely plays twice in a row.
+    """
+
+    MODES = ('random', 'weighted', 'recent', 'spread')
+    UNRATED = 2.5
+    RECENCY = 3 * 24 * 3600
+
+    def __init__(self, index):
+        self.index = index
+        rating = numpy.array(index.columns['rating'], dtype=numpy.float64)
+        rating[rating <= 0] = self.UNRATED
+        plays = numpy.array(index.columns['play_count'], dtype=numpy.float64)
+        self.weights = (1 + rating) * (1 + numpy.log1p(numpy.maximum(plays, 0)))
+
+    def order(self, track_ids, mode='random', rng=None, now=None):
+        """The tracks in a shuffled order, as an array of track ids."""
+        rng = rng or numpy.random.default_rng()
+        ids = numpy.array(track_ids, dtype=numpy.int32)
+        if mode not in self.MODES[1:] or len(ids) < 2:
+            rng.shuffle(ids)
+            return array('i', ids.tobytes())
+        weights = self.weights[ids]
+        if mode == 'recent':
+            now = time.time() if now is None else now
+            played = numpy.array([self.index.columns['last_played'][i] for i in ids], dtype=numpy.float64)
+            age = numpy.where(played > 0, now - played, numpy.inf)
+            weights = weights * numpy.maximum(-numpy.expm1(-age / self.RECENCY), 0.01)
+        ids = ids[numpy.argsort(rng.exponential(size=len(ids)) / weights, kind='stable')]
+        if mode == 'spread':
+            ids = ids[numpy.argsort(self._spread(ids, rng), kind='stable')]
+        return array('i', ids.tobytes())
+
+    def _spread(self, ids, rng):
+        """Position in [0, 1) of each track when its artist's tracks are spaced evenly."""
+        artist_column = self.index.columns['artist']
+        artists = numpy.array([artist_column[i] for i in ids], dtype=numpy.int64)
+        grouped = numpy.argsort(artists, kind='stable')
+        names, starts, counts = numpy.unique(artists[grouped], return_index=True, return_counts=True)
+        group = numpy.repeat(numpy.arange(len(names)), counts)
+        rank = numpy.arange(len(ids)) - starts[group]
+        positions = numpy.empty(len(ids))
+        positions[grouped] = (rank + rng.random(len(names))[group]) / counts[group]
+        return positions
+
+
+class Library(object):
+    """Everything a query needs, built together and never modified.
+
+    The skill publishes a new Library by replacing its ``library``
+    reference in one assignment, so a request that reads the reference
+    once sees a complete index, playlists and matcher even while the
+    next one is being built.
+    """
+
+    def __init__(self, index, playlist_index, fingerprints, generation, shortlist=300, pool=None,
+                 spoken=None):
+        self.index = index
+        self.playlist_index = playlist_index
+        self.playlists = playlist_index.names
+        self.automatic_playlists = {name: AutomaticPlaylist(definition, index)
+                                    for name, definition in playlist_index.automatic.items()}
+        self.shuffler = ShuffleEngine(index)
+        self.fingerprints = fingerprints
+        self.generation = generation
+        self.titles = index.names('title')
+        self.artists = index.names('artist')
+        self.albums = index.names('album')
+        self.genres = index.names('genre')
+        # Alternate forms added to the match lists, as (count, bytes)
+        self.spoken_forms = (0, 0)
+        self.resolvers = {
+            "by": ByResolver(index.catalogue('by', 'title'), " by ", spoken=spoken),
+            "album_by": ByResolver(index.catalogue('album_by', 'album'), " album by ", spoken=spoken),
+        }
+        corpora = {
+            "genre": self.genres,
+            "playlist": self.playlists,
+            "artist": self.artists,
+            "album": self.albums,
+            "title": self.titles,
+        }
+        forms = None
+        if spoken is not None:
+            forms = {}
+            for category, names in corpora.items():
+                corpora[category], forms[category] = spoken.expand(names)
+            self.spoken_forms = (spoken.count, spoken.size)
+        if pool is not None:
+            self.matcher = ShardedMatchEngine(corpora, pool, generation, self.resolvers, forms)
+        else:
+            self.matcher = MatchEngine(corpora, shortlist, self.resolvers, forms)
+
+    def is_empty(self):
+        return not self.playlists and not len(self.index)
+
+    def playlist_tracks(self, name):
+        """Track ids of a playlist in play order, or None if there is none by that name."""
+        if name in self.automatic_playlists:
+            return self.automatic_playlists[name].tracks()
+        return self.playlist_index.static.get(name)
+
+    def with_fingerprints(self, fingerprints):
+        """The same library, recorded as built from files with new fingerprints."""
+        library = copy.copy(self)
+        library.fingerprints = fingerprints
+        return library
+
+    def lists_memory_usage(self):
+        return _sizeof([self.titles, self.artists, self.albums, self.genres,
+                        self.resolvers])
+
+
+class TrackListeners(object):
+    """Track-change callbacks for players that can report them.
+
+    Listeners are called with the URI of the new track, from whichever
+    thread noticed the change, and must not block.
+    """
+
+    reports_track_changes = False
+
+    def add_track_listener(self, listener):
+        self.track_listeners = getattr(self, 'track_listeners', []) + [listener]
+
+    def remove_track_listener(self, listener):
+        listeners = getattr(self, 'track_listeners', [])
+        self.track_listeners = [l for l in listeners if l != listener]
+
+    def _track_changed(self, uri):
+        for listener in getattr(self, 'track_listeners', []):
+            listener(uri)
+
+
+class RhythmboxClientPlayer(TrackListeners):
+    """Controls Rhythmbox by running rhythmbox-client for every command.
+
+    rhythmbox-client cannot report track changes, so windowed queue
+    feeding is not available with this player.
+    """
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics or Metrics()
+        self.now_playing = {}
+
+    def _run(self, *args):
+        self.metrics.count('processes')
+        with self.metrics.span('player.process'):
+            subprocess.call(["rhythmbox-client"] + list(args))
+
+    def play(self):
+        self._run("--play")
+
+    def pause(self):
+        self._run("--pause")
+
+    def stop(self):
+        self._run("--stop")
+
+    def next(self):
+        self._run("--next")
+
+    def previous(self):
+        self._run("--previous")
+
+    def clear_queue(self):
+        self._run("--clear-queue")
+
+    def enqueue(self, uris, chunk_size=200):
+        for i in range(0, len(uris), chunk_size):
+            self._run("--enqueue", *uris[i:i + chunk_size])
+
+    def quit(self):
+        self.metrics.count('processes')
+        subprocess.call(["pkill", "rhythmbox"])
+
+    def shutdown(self):
+        pass
+
+
+class DBusPlayer(RhythmboxClientPlayer):
+    """Controls Rhythmbox over one long-lived D-Bus session connection.
+
+    Transport controls use the MPRIS2 Player interface and the play queue
+    the org.gnome.Rhythmbox3.PlayQueue interface, so no process is started
+    per command. PlaybackStatus and Metadata are cached in ``now_playing``
+    from PropertiesChanged signals, dispatched by a GLib main loop on a
+    daemon thread, and a change of xesam:url is passed on to the track
+    listeners. Only Rhythmbox's signals are received, on a private
+    connection that ``shutdown`` closes. When Rhythmbox is not running the commands fall back to
+    rhythmbox-client, which launches it.
+    """
+
+    reports_track_changes = True
+
+    MPRIS_NAME = 'org.mpris.MediaPlayer2.rhythmbox'
+    MPRIS_PATH = '/org/mpris/MediaPlayer2'
+    MPRIS_PLAYER = 'org.mpris.MediaPlayer2.Player'
+    QUEUE_NAME = 'org.gnome.Rhythmbox3'
+    QUEUE_PATH = '/org/gnome/Rhythmbox3/PlayQueue'
+    QUEUE_IFACE = 'org.gnome.Rhythmbox3.PlayQueue'
+
+    def __init__(self, metrics=None):
+        super(DBusPlayer, self).__init__(metrics)
+        import dbus
+        from dbus.mainloop.glib import DBusGMainLoop
+        from gi.repository import GLib
+        self._dbus = dbus
+        # A private connection is the only one that is sure to dispatch on
+        # the main loop below, and it can be closed without breaking other
+        # users of the shared session bus in this process
+        self._bus = dbus.SessionBus(private=True, mainloop=DBusGMainLoop())
+        self._bus.add_signal_receiver(self._properties_changed,
+                                      signal_name='PropertiesChanged',
+                                      dbus_interface='org.freedesktop.DBus.Properties',
+                                      bus_name=self.MPRIS_NAME,
+                                      path=self.MPRIS_PATH)
+        self._loop = GLib.MainLoop()
+        threading.Thread(target=self._loop.run, daemon=True).start()
+        try:
+            props = self._interface(self.MPRIS_NAME, self.MPRIS_PATH,
+                                    'org.freedesktop.DBus.Properties')
+            self._properties_changed(self.MPRIS_PLAYER, props.GetAll(self.MPRIS_PLAYER), [])
+        except dbus.DBusException:
+            pass
+
+    def _interface(self, name, path, iface):
+        obj = self._bus.get_object(name, path, introspect=False)
+        return self._dbus.Interface(obj, iface)
+
+    def _properties_changed(self, iface, changed, invalidated):
+        if iface != self.MPRIS_PLAYER:
+            return
+        if 'PlaybackStatus' in changed:
+            self.now_playing['status'] = str(changed['PlaybackStatus'])
+        if 'Metadata' in changed:
+            metadata = changed['Metadata']
+            previous = self.now_playing.get('metadata', {}).get('xesam:url')
+            self.now_playing['metadata'] = {str(k): str(v) for k, v in metadata.items()}
+            uri = self.now_playing['metadata'].get('xesam:url')
+            if uri and uri != previous:
+                self._track_changed(uri)
+
+    def _call(self, name, path, iface, method, *args):
+        self.metrics.count('dbus_calls')
+        try:
+            with self.metrics.span('player.dbus'):
+                getattr(self._interface(name, path, iface), method)(*args)
+            return True
+        except self._dbus.DBusException as e:
+            logger.info("D-Bus call {} failed: {}".format(method, e))
+            return False
+
+    def _mpris(self, method, fallback):
+        if not self._call(self.MPRIS_NAME, self.MPRIS_PATH, self.MPRIS_PLAYER, method):
+            fallback()
+
+    def play(self):
+        self._mpris('Play', super(DBusPlayer, self).play)
+
+    def pause(self):
+        self._mpris('Pause', super(DBusPlayer, self).pause)
+
+    def stop(self):
+        self._mpris('Stop', super(DBusPlayer, self).stop)
+
+    def next(self):
+        self._mpris('Next', super(DBusPlayer, self).next)
+
+    def previous(self):
+        self._mpris('Previous', super(DBusPlayer, self).previous)
+
+    def clear_queue(self):
+        if not self._call(self.QUEUE_NAME, self.QUEUE_PATH, self.QUEUE_IFACE, 'ClearQueue'):
+            super(DBusPlayer, self).clear_queue()
+
+    def enqueue(self, uris, chunk_size=200):
+        for i, uri in enumerate(uris):
+            if not self._call(self.QUEUE_NAME, self.QUEUE_PATH, self.QUEUE_IFACE, 'AddToQueue', uri):
+                super(DBusPlayer, self).enqueue(uris[i:], chunk_size)
+                return
+
+    def quit(self):
+        if not self._call(self.MPRIS_NAME, self.MPRIS_PATH, 'org.mpris.MediaPlayer2', 'Quit'):
+            super(DBusPlayer, self).quit()
+
+    def shutdown(self):
+        self._loop.quit()
+        self._bus.close()
+
+
+class FakePlayer(TrackListeners):
+    """In-process stand-in for Rhythmbox.
+
+    Keeps a play queue and now-playing state the way Rhythmbox would and
+    records every command in ``commands``, so playback behaviour and the
+    skill's own latency can be exercised without a real player. ``latency``
+    seconds are slept per command to model a slow one.
+    """
+
+    reports_track_changes = True
+
+    def __init__(self, metrics=None, latency=0):
+        self.metrics = metrics or Metrics()
+        self.latency = latency
+        self.commands = []
+        self.queue = []
+        self.now_playing = {'status': 'Stopped', 'metadata': {}}
+
+    def _command(self, *command):
+        self.metrics.count('fake_commands')
+        self.commands.append(command)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _set_current(self, uri):
+        self.now_playing['metadata'] = {'xesam:url': uri} if uri else {}
+        if uri:
+            self._track_changed(uri)
+
+    def play(self):
+        self._command('play')
+        if not self.now_playing['metadata'] and self.queue:
+            self._set_current(self.queue.pop(0))
+        if self.now_playing['metadata']:
+            self.now_playing['status'] = 'Playing'
+
+    def pause(self):
+        self._command('pause')
+        if self.now_playing['status'] == 'Playing':
+            self.now_playing['status'] = 'Paused'
+
+    def stop(self):
+        self._command('stop')
+        self._set_current(None)
+        self.now_playing['status'] = 'Stopped'
+
+    def next(self):
+        self._command('next')
+        self._set_current(self.queue.pop(0) if self.queue else None)
+        if not self.now_playing['metadata']:
+            self.now_playing['status'] = 'Stopped'
+
+    def previous(self):
+        self._command('previous')
+
+    def clear_queue(self):
+        self._command('clear_queue')
+        self.queue = []
+
+    def enqueue(self, uris, chunk_size=200):
+        self._command('enqueue', len(uris))
+        self.queue.extend(uris)
+
+    def quit(self):
+        self._command('quit')
+        self.queue = []
+        self.now_playing = {'status': 'Stopped', 'metadata': {}}
+
+    def shutdown(self):
+        pass
+
+
+class CommandExecutor(object):
+    """Runs player commands in order on a worker thread.
+
+    ``submit`` queues a player method by name and ``run`` any callable,
+    and both return straight away. At most ``size`` commands wait; more
+    are dropped with a log line. A command is merged into the one waiting
+    before it when that gives the same outcome: consecutive next and
+    previous become a single step count, a repeated play, pause, stop or
+    quit is dropped, and a play replaces a waiting stop or quit. Callables
+    are never merged.
+
+    ``before_stop`` is called on the worker before a stop or quit runs, to
+    cancel anything that would go on adding to the play queue.
+
+    With metrics enabled, the wait in the queue and the run time of every
+    command are recorded as ``command.wait`` and ``command.<name>``;
+    ``stats`` reports the queue depth and counters.
+    """
+
+    STEPS = {'next': 1, 'previous': -1}
+    REPEATABLE = ('play', 'pause', 'stop', 'quit')
+
+    def __init__(self, player, metrics=None, size=32, before_stop=None):
+        self.player = player
+        self.metrics = metrics or Metrics()
+        self.size = size
+        self.before_stop = before_stop
+        self.pending = deque()
+        self.running = False
+        self.condition = threading.Condition()
+        self.submitted = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, command):
+        with self.condition:
+            self.submitted += 1
+            if not self.pending or not self._merge(self.pending[-1], command):
+                if command in self.STEPS:
+                    return self._append(['step', None, self.STEPS[command]])
+                return self._append([command, None, 0])
+            self.coalesced += 1
+            last = self.pending[-1]
+            if last[0] != 'step' or last[2]:
+                return True
+            # The steps cancelled out, so nothing runs for the request holding them
+            self.pending.pop()
+        self.metrics.release(last[3])
+        return True
+
+    def run(self, name, function):
+        with self.condition:
+            self.submitted += 1
+            return self._append([name, function, 0])
+
+    def _merge(self, last, command):
+        name = last[0]
+        if name == 'step' and command in self.STEPS:
+            last[2] += self.STEPS[command]
+            return True
+        if command in self.REPEATABLE and name == command:
+            return True
+        if command == 'play' and name in ('stop', 'quit'):
+            last[0] = 'play'
+            return True
+        return False
+
+    def _append(self, item):
+        if len(self.pending) >= self.size:
+            self.dropped += 1
+            logger.warning("Player command queue is full, dropping {}".format(item[0]))
+            return False
+        # Counts and stages of the command belong to the request queueing it
+        request = self.metrics.current()
+        self.metrics.hold(request)
+        item.append(request)
+        item.append(time.perf_counter())
+        self.pending.append(item)
+        self.max_depth = max(self.max_depth, len(self.pending))
+        self.condition.notify()
+        return True
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.running = False
+                self.condition.notify_all()
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                name, function, steps, request, submitted = self.pending.popleft()
+                self.running = True
+            with self.metrics.resume(request):
+                self._execute(name, function, steps, submitted)
+
+    def _execute(self, name, function, steps, submitted):
+        start = time.perf_counter()
+        try:
+            if function is not None:
+                function()
+            elif name == 'step':
+                step = self.player.next if steps > 0 else self.player.previous
+                for _ in range(abs(steps)):
+                    step()
+            else:
+                if name in ('stop', 'quit') and self.before_stop is not None:
+                    self.before_stop()
+                getattr(self.player, name)()
+        except Exception:
+            logger.exception("Player command {} failed".format(name))
+        if self.metrics.enabled:
+            self.metrics.record('command.wait', start - submitted)
+            self.metrics.record('command.' + name, time.perf_counter() - start)
+
+    def join(self, timeout=None):
+        """Wait until every submitted command has run."""
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending and not self.running, timeout)
+
+    def stats(self):
+        with self.condition:
+            return {
+                'depth': len(self.pending),
+                'max_depth': self.max_depth,
+                'size': self.size,
+                'submitted': self.submitted,
+                'coalesced': self.coalesced,
+                'dropped': self.dropped,
+            }
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join(5)
+
+
+PLAYERS = {
+    'client': RhythmboxClientPlayer,
+    'dbus': DBusPlayer,
+    'fake': FakePlayer,
+}
+
+
+# What is said when a selection starts playing.
+SELECTION_DIALOGS = {
+    "playlist": "selecting playlist",
+    "artist": "selecting artist",
+    "album": "selecting album",
+    "album_by": "selecting album",
+}
+
+
+def _selection(data):
+    """(kind, values) of the tracks a CPS match refers to, or None.
+
+    Follows the precedence of CPS_start: "X by Y" first, then genre,
+    title, artist, playlist and album.
+    """
+    if 'by' in data:
+        if 'album' in data:
+            return "album_by", (data['by'], data['album'])
+        if 'title' in data:
+            return "by", (data['by'], data['title'])
+    for kind in ("genre", "title", "artist", "playlist", "album"):
+        if kind in data:
+            return kind, (data[kind],)
+    return None
+
 
 class RhythmboxSkill(CommonPlaySkill):
 
@@ -52,15 +2354,42 @@ class RhythmboxSkill(CommonPlaySkill):
         self.rhythmbox_database_xml = expanduser('~/.local/share/rhythmbox/rhythmdb.xml')
         self.shuffle = False
         self.debug_mode = True
-        self.playlists = []
-        self.titles = []
-        self.artists = []
-        self.bys = []
-        self.albums = []
-        self.album_bys = []
-        self.genres = []
+        self.library = Library(TrackIndex(), PlaylistIndex(), {}, 0)
+        vocab = os.path.join(self.root_dir, 'vocab')
+        self.grammar = PhraseGrammar.load(os.path.join(vocab, self.lang),
+                                          os.path.join(vocab, 'en-us'))
+        self.query_cache = QueryCache()
+        # Track ids of recently matched selections, see _tracks
+        self.selections = QueryCache(64)
+        self.metrics = Metrics()
+        # Published when a request and the player commands it queued are done
+        self.metrics.listener = self._emit_request
+        self.player = None
+        self.commands = None
+        self.match_pool = None
+        self._feeder = None
+        self._file_check = None
+        self._watcher = None
+        self._build_lock = threading.Lock()
+        self._builder = None
+        self._build_requested = False
+        self._force_build = False
+
+    @property
+    def snapshot_file(self):
+        return os.path.join(self.file_system.path, 'index.snapshot')
 
     def initialize(self):
+        self.metrics.enabled = _is_true(self.settings.get('metrics_enabled', False))
+        workers = int(self.settings.get('match_workers', 0))
+        if workers > 1:
+            self.match_pool = ShardPool(workers)
+        self.player = self._create_player()
+        self.commands = CommandExecutor(self.player, self.metrics,
+                                        max(1, int(self.settings.get('command_queue_size', 32))),
+                                        before_stop=self._cancel_feeder)
+        self.query_cache.size = int(self.settings.get('query_cache_size', 256))
+
         stop_rhythmbox_intent = IntentBuilder("StopRhythmboxIntent"). \
             require("StopKeyword").require("RhythmboxKeyword").build()
         self.register_intent(stop_rhythmbox_intent, self.handle_stop_rhythmbox_intent)
@@ -80,21 +2409,73 @@ class RhythmboxSkill(CommonPlaySkill):
         self.add_event('mycroft.audio.service.prev', self.handle_canned_previous_song)
         self.add_event('mycroft.audio.service.stop', self.handle_canned_stop)
 
-        # Pre-build cache
-        self._build_cache()
-        # Rebuild cache every hour
-        self.schedule_repeating_event(self._build_cache, None, 3600)
+        self.add_event('rhythmbox.query_cache.stats', self.handle_query_cache_stats)
+        self.add_event('rhythmbox.metrics.summary', self.handle_metrics_summary)
+
+        # Pre-build cache in the background, starting from the last
+        # snapshot so that only changes made since then require parsing
+        # the XML files
+        self._start_build()
+        # Rebuild cache when Rhythmbox saves its files, or poll for changes
+        # if they cannot be watched
+        self._watcher = self._create_watcher()
+        if self._watcher is None:
+            poll = max(1, int(self.settings.get('reload_poll_interval', 60)))
+            self.schedule_repeating_event(self._scheduled_build, None, poll)
+        # Look for missing files every hour
+        self.schedule_repeating_event(self._check_files, None, 3600)
 
     def CPS_match_query_phrase(self, phrase):
-        ordering = {}
         if self.debug_mode:
-            logger.info('CPS_match_query: ' + phrase)
-        if not self.playlists and not self.titles and not self.artists and not self.albums and not self.genres:
-            self._build_cache()
+            logger.info('CPS_match_query: %s', phrase)
+        with self._request("match"):
+            return self._cached_match(phrase)
+
+    def _cached_match(self, phrase):
+        library = self.library
+        if library.is_empty():
+            # Never block a query on an index build
+            self._start_build()
+            return None
+        key = ("match", _normalize_phrase(phrase))
+        match = self.query_cache.get(key, library.generation)
+        if match is QueryCache.MISSING:
+            match = self._match_query_phrase(key[1], library)
+            self.query_cache.put(key, match, library.generation)
+        if match is None:
+            return None
+        data = dict(match[2])
+        selection = _selection(data)
+        if selection is not None:
+            # Resolve the tracks now so CPS_start only has to queue them.
+            # Automatic playlists are evaluated again when they start, so
+            # they are left to CPS_start alone.
+            kind, values = selection
+            if kind != "playlist" or values[0] not in library.automatic_playlists:
+                self._tracks(library, kind, values)
+            data["tracks"] = {
+                "handle": [kind] + list(values),
+                "generation": library.generation,
+            }
+        return (phrase, match[1], data)
+
+    def _match_query_phrase(self, phrase, library):
+        # Listed in the order _best_match reads them, so that a sharded
+        # matcher scores the categories that can decide the match first
+        categories = ["genre", "playlist", "artist", "album", "title"]
+        if "by" in phrase:
+            categories = ["by", "album_by"] + categories
+        # Scores may be computed as _best_match reads them, so the score
+        # stage covers the cascade as well
+        with self.metrics.span("score"), self._search(phrase, categories, library) as scores:
+            return self._best_match(phrase, scores)
+
+    def _best_match(self, phrase, scores):
+        ordering = {}
         if "by" in phrase:
-            album, album_by, confidence = self._search_album_by(phrase)
+            album, album_by, confidence = self._search_album_by(phrase, scores)
             ordering["album by"] = confidence
-            title, title_by, confidence = self._search_by(phrase)
+            title, title_by, confidence = self._search_by(phrase, scores)
             ordering["title by"] = confidence
             ordered = sorted(ordering, key=ordering.__getitem__, reverse=True)
             if "album by" == ordered[0] and ordering["album by"] > 75:
@@ -102,31 +2483,31 @@ class RhythmboxSkill(CommonPlaySkill):
             elif "title by" == ordered[0] and ordering["title by"] > 65:
                 return (phrase, CPSMatchLevel.MULTI_KEY, {"by": title_by, "title": title, "confidence": ordering["title by"]})
         ordering = {}
-        genre, confidence = self._search_genre(phrase)
+        genre, confidence = self._search_genre(phrase, scores)
         ordering["genre"] = confidence
         # If we have a high confidence genre, start playing
         # without parsing additional properties.
         if "playlist" not in phrase and confidence > 95:
             return (phrase, CPSMatchLevel.EXACT, {"genre": genre, "confidence": confidence})
-        playlist, confidence = self._search_playlist(phrase)
+        playlist, confidence = self._search_playlist(phrase, scores)
         ordering["playlist"] = confidence
         # If we have a high confidence playlist, start playing
         # without parsing additional properties.
         if confidence >= 95:
             return (phrase, CPSMatchLevel.EXACT, {"playlist": playlist, "confidence": confidence})
-        artist, confidence = self._search_artist(phrase)
+        artist, confidence = self._search_artist(phrase, scores)
         ordering["artist"] = confidence
         # If we have a high confidence artist, start playing
         # without parsing additional properties.
         if "playlist" not in phrase and confidence >= 95:
             return (phrase, CPSMatchLevel.EXACT, {"artist": artist, "confidence": confidence})
-        album, confidence = self._search_album(phrase)
+        album, confidence = self._search_album(phrase, scores)
         ordering["album"] = confidence
         # If we have a high confidence album, start playing
         # without parsing additional properties.
         if "playlist" not in phrase and confidence >= 95:
             return (phrase, CPSMatchLevel.EXACT, {"album": album, "confidence": confidence})
-        title, confidence = self._search_title(phrase)
+        title, confidence = self._search_title(phrase, scores)
         ordering["title"] = confidence
         # If we have a high confidence title, start playing
         # without parsing additional properties.
@@ -134,7 +2515,7 @@ class RhythmboxSkill(CommonPlaySkill):
             return (phrase, CPSMatchLevel.EXACT, {"title": title, "confidence": confidence})
         # Parsed all properties, no high confidence property except perhaps album.
         # Do lower confidence returns now.
-        if "on rhythmbox" in phrase or "on rhythm box" in phrase:
+        if "on_rhythmbox" in self.grammar.parse(phrase)[1]:
             ordered = sorted(ordering, key=ordering.__getitem__, reverse=True)
             if "playlist" == ordered[0] and ordering["playlist"] > 65:
                 return (phrase, CPSMatchLevel.MULTI_KEY, {"playlist": playlist, "confidence": ordering["playlist"]})
@@ -164,9 +2545,19 @@ class RhythmboxSkill(CommonPlaySkill):
             return None
 
     def CPS_start(self, phrase, data):
-        self.shuffle = False
         if self.debug_mode:
-            logger.info('CPS_start: ' + phrase)
+            logger.info('CPS_start: %s', phrase)
+        with self._request("start"):
+            self._start(data)
+
+    def _start(self, data):
+        self.shuffle = False
+        tracks = data.get('tracks')
+        if tracks is not None and tracks['generation'] == self.library.generation:
+            kind, values = tracks['handle'][0], tuple(tracks['handle'][1:])
+            with self.metrics.span("play." + kind):
+                self._play_selection(kind, values)
+            return None
         if 'by' in data:
             if 'album' in data:
                 self._play_album_by(data['by'], data['album'], data['confidence'])
@@ -187,447 +2578,570 @@ class RhythmboxSkill(CommonPlaySkill):
 
     def handle_stop_rhythmbox_intent(self, message):
         logger.info("Stop Rhythmbox")
-        os.system("pkill rhythmbox")
+        self.commands.submit('quit')
         self.speak_dialog("stop.rhythmbox")
 
     def handle_shuffle_rhythmbox_intent(self, message):
+        with self._request("shuffle"):
+            self._shuffle(message)
+
+    def _shuffle(self, message):
         self.shuffle = True
-        ordering = {}
         utterance = message.utterance_remainder() + " "
         if self.debug_mode:
-            logger.info('Shuffle: ' + utterance)
-        playlist, confidence = self._search_playlist(utterance)
+            logger.info('Shuffle: %s', utterance)
+        library = self.library
+        key = ("shuffle", _normalize_phrase(utterance))
+        selection = self.query_cache.get(key, library.generation)
+        if selection is QueryCache.MISSING:
+            selection = self._match_shuffle(key[1] + " ", library)
+            self.query_cache.put(key, selection, library.generation)
+        if selection is None:
+            return None
+        kind, args = selection
+        if kind == "playlist":
+            self._play_playlist(*args)
+        elif kind == "album":
+            self._play_album(*args)
+        elif kind == "album by":
+            self._play_album_by(*args)
+
+    def _match_shuffle(self, utterance, library):
+        ordering = {}
+        scores = self._match(utterance, ["playlist", "album", "album_by"], library)
+        playlist, confidence = self._search_playlist(utterance, scores)
         ordering["playlist"] = confidence
-        album, confidence = self._search_album(utterance)
+        album, confidence = self._search_album(utterance, scores)
         ordering["album"] = confidence
-        album_by, artist, confidence = self._search_album_by(utterance)
+        album_by, artist, confidence = self._search_album_by(utterance, scores)
         ordering["album by"] = confidence
         ordered = sorted(ordering, key=ordering.__getitem__, reverse=True)
-        if "playlist" == ordered[0] and ordering["playlist"] > 65: 
-            self._play_playlist(playlist, ordering["playlist"])
-        elif "album" == ordered[0] and ordering["album"] > 75: 
-            self._play_album(album, ordering["album"])
+        if "playlist" == ordered[0] and ordering["playlist"] > 65:
+            return "playlist", (playlist, ordering["playlist"])
+        elif "album" == ordered[0] and ordering["album"] > 75:
+            return "album", (album, ordering["album"])
         elif "album by" == ordered[0] and ordering["album by"] > 75:
-            self._play_album_by(artist, album_by, ordering["album by"])
+            return "album by", (artist, album_by, ordering["album by"])
         else:
-            return None 
+            return None
 
     def handle_refresh_database_intent(self, message):
         self.speak_dialog("Refreshing Rhythmbox database")
-        self._build_cache()
+        self._start_build(force=True)
+
+    def handle_query_cache_stats(self, message):
+        self.bus.emit(message.response(self.query_cache.stats()))
+
+    def handle_metrics_summary(self, message):
+        summary = self.metrics.summary()
+        summary['commands'] = self.commands.stats()
+        self.bus.emit(message.response(summary))
+
+    @contextmanager
+    def _request(self, name):
+        """Time a request and publish its stages once the commands it queued have run."""
+        self.metrics.begin(name)
+        try:
+            with self.metrics.span(name):
+                yield
+        finally:
+            self.metrics.end()
+
+    def _emit_request(self, request):
+        self.bus.emit(Message('rhythmbox.metrics.request', request))
 
     def handle_canned_pause(self, message):
-        os.system("rhythmbox-client --pause")
+        with self._request("pause"):
+            self.commands.submit('pause')
     
     def handle_canned_stop(self, message):        
         logger.info("Stop Rhythmbox")
-        os.system("pkill rhythmbox")
+        self.commands.submit('quit')
         self.speak_dialog("stop.rhythmbox")
 
     def handle_canned_resume(self, message):
-        os.system("rhythmbox-client --play")
+        with self._request("play"):
+            self.commands.submit('play')
 
     def handle_canned_next_song(self, message):
-        os.system("rhythmbox-client --next")
+        with self._request("next"):
+            self.commands.submit('next')
 
     def handle_canned_previous_song(self, message):
-        os.system("rhythmbox-client --previous")
+        with self._request("previous"):
+            self.commands.submit('previous')
 
-    def _build_cache(self):
+    def _scheduled_build(self):
+        self._start_build()
+
+    def _create_watcher(self):
+        if not _is_true(self.settings.get('watch_files', True)):
+            return None
+        try:
+            return FileWatcher([self.rhythmbox_database_xml, self.rhythmbox_playlist_xml],
+                               self._scheduled_build)
+        except Exception as e:
+            logger.info("Cannot watch the Rhythmbox files, polling instead: {}".format(e))
+            return None
+
+    def _check_files(self):
+        """Start a FileCheck over the current index, replacing any running one.
+
+        A file_check_rate of 0 or less turns the check off.
+        """
+        if self._file_check is not None:
+            self._file_check.cancel()
+            self._file_check = None
+        rate = int(self.settings.get('file_check_rate', 200))
+        if rate > 0:
+            self._file_check = FileCheck(self.library.index, rate)
+
+    def _start_build(self, force=False):
+        """Bring the library up to date on a worker thread.
+
+        Requests made while a build is running are folded into one more
+        pass of the same worker.
+        """
+        with self._build_lock:
+            self._build_requested = True
+            self._force_build = self._force_build or force
+            if self._builder is not None:
+                return
+            self._builder = threading.Thread(target=self._run_builds, daemon=True)
+            self._builder.start()
+
+    def _run_builds(self):
+        while True:
+            with self._build_lock:
+                if not self._build_requested:
+                    self._builder = None
+                    return
+                self._build_requested = False
+                force = self._force_build
+                self._force_build = False
+            try:
+                if self.library.is_empty() and self.library.generation == 0:
+                    self._load_snapshot()
+                self._build_cache(force)
+            except Exception:
+                logger.exception("Building the Rhythmbox index failed")
+
+    @_timed("build")
+    def _build_cache(self, force=False):
+        library = self.library
+        fingerprints = {
+            self.rhythmbox_database_xml: _file_fingerprint(self.rhythmbox_database_xml),
+            self.rhythmbox_playlist_xml: _file_fingerprint(self.rhythmbox_playlist_xml),
+        }
+        old = {} if force else library.fingerprints
+        if fingerprints == old:
+            logger.info("Cache is up to date")
+            return
         logger.info("Building Cache")
-        self.playlists = []
-        self.titles = []
-        self.artists = []
-        self.bys = []
-        self.albums = []
-        self.album_bys = []
-        self.genres = []
-        tree = ET.parse(self.rhythmbox_database_xml)
-        root = tree.getroot()
-        for entry in root.iter('entry'):
-            if entry.attrib["type"] == 'song':
-                genre = entry.find('genre').text.lower()
-                artist = entry.find('artist').text.lower()
-                title = entry.find('title').text.lower()
-                album = entry.find('album').text.lower()
-                self.bys.append(title + " by " + artist)
-                self.album_bys.append(album + " album by " + artist)
-                if genre not in self.genres:
-                    self.genres.append(genre)
-                if artist not in self.artists:
-                    self.artists.append(artist)
-                if album not in self.albums:
-                    self.albums.append(album)
-                if title not in self.titles:
-                    self.titles.append(title)
-        tree = ET.parse(self.rhythmbox_playlist_xml)
-        root = tree.getroot()
-        for playlist in root.iter('playlist'):
-            self.playlists.append(playlist.get('name'))
+        index = library.index
+        songs_changed = fingerprints[self.rhythmbox_database_xml] != old.get(self.rhythmbox_database_xml)
+        if songs_changed:
+            index = index.copy()
+            added, changed, removed = index.update(_iter_songs(self.rhythmbox_database_xml))
+            logger.info("Cache delta: {} added, {} changed, {} removed".format(added, changed, removed))
+            if not (added or changed or removed) and not force:
+                # Rhythmbox rewrites its files on exit even when nothing
+                # changed; keep the published index and its matcher
+                index = library.index
+        playlists = library.playlist_index
+        # Playlists hold track ids, so they are resolved again when the songs change
+        if index is not library.index or fingerprints[self.rhythmbox_playlist_xml] != old.get(self.rhythmbox_playlist_xml):
+            playlists = PlaylistIndex.parse(self.rhythmbox_playlist_xml, index)
+            if index is library.index and playlists.to_snapshot() == library.playlist_index.to_snapshot():
+                playlists = library.playlist_index
+        if index is library.index and playlists is library.playlist_index and not force:
+            logger.info("Cache is up to date, files were saved without changes")
+            self.library = library.with_fingerprints(fingerprints)
+        else:
+            self._publish(index, playlists, fingerprints)
+        self._save_snapshot()
+
+    def _publish(self, index, playlists, fingerprints):
+        library = Library(index, playlists, fingerprints, self.library.generation + 1,
+                          int(self.settings.get('match_shortlist_size', 300)), self.match_pool,
+                          SpokenForms.from_setting(self.settings.get('spoken_forms')))
+        logger.info("Track store: {} tracks in {} KiB, playlists {} KiB, match lists {} KiB, "
+                    "{} spoken forms in {} KiB".format(
+                        len(index), index.memory_usage() // 1024, playlists.memory_usage() // 1024,
+                        library.lists_memory_usage() // 1024, library.spoken_forms[0],
+                        library.spoken_forms[1] // 1024))
+        self.library = library
+        self._check_files()
+
+    def _create_player(self):
+        backend = self.settings.get('player_backend', 'dbus')
+        try:
+            return PLAYERS.get(backend, DBusPlayer)(self.metrics)
+        except Exception as e:
+            logger.info("Player backend {} unavailable, using rhythmbox-client: {}".format(backend, e))
+            return RhythmboxClientPlayer(self.metrics)
+
+    def _load_snapshot(self):
+        try:
+            with open(self.snapshot_file, 'rb') as f:
+                snapshot = pickle.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning("Ignoring unreadable index snapshot: {}".format(e))
+            return
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            logger.info("Ignoring index snapshot from another version")
+            return
+        self._publish(TrackIndex.from_snapshot(snapshot['index']),
+                      PlaylistIndex.from_snapshot(snapshot['playlists']),
+                      snapshot['fingerprints'])
+        logger.info("Loaded index snapshot")
+
+    def _save_snapshot(self):
+        library = self.library
+        snapshot = {
+            'version': SNAPSHOT_VERSION,
+            'fingerprints': library.fingerprints,
+            'index': library.index.to_snapshot(),
+            'playlists': library.playlist_index.to_snapshot(),
+        }
+        tmp = self.snapshot_file + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.snapshot_file)
+        except OSError as e:
+            logger.warning("Could not save index snapshot: {}".format(e))
 
     def _general_artist_request(self, phrase):
-        if "something by" in phrase:
-            return True
-        if "music by" in phrase:
-            return True
-        if "tunes by" in phrase:
-            return True
-        if "a song by" in phrase:
-            return True
-        if "some songs by" in phrase:
-            return True
-        if "music from" in phrase:
-            return True
-        if "tunes from" in phrase:
-            return True
-        if "a song from" in phrase:
-            return True
-        if "some songs from" in phrase:
-            return True
-        return False
+        return "general_artist" in self.grammar.parse(phrase)[1]
+
+    def _utterance(self, category, phrase):
+        """The part of a phrase that is matched against a category."""
+        if category == "by":
+            return phrase
+        if category == "album_by":
+            if "album" in phrase:
+                utterance = phrase.replace("album", " ")
+                return utterance.replace(" by ", " album by ")
+            return phrase
+        return self.grammar.parse(phrase)[0][category]
 
-    def _search_playlist(self, phrase):
-        utterance = phrase + " "
-        strip_these = ["playlist ", "on rhythmbox ", "on rhythm box "]
-        for words in strip_these:
-            utterance = utterance.replace(words, " ")
-        utterance.lstrip()
+    @_timed("score")
+    def _match(self, phrase, categories, library=None):
+        """Score a phrase against several categories in one pass."""
+        library = library or self.library
+        return library.matcher.best({category: self._utterance(category, phrase)
+                                     for category in categories})
+
+    @contextmanager
+    def _search(self, phrase, categories, library=None):
+        """Like _match, but categories may be scored as they are read."""
+        library = library or self.library
+        with library.matcher.search({category: self._utterance(category, phrase)
+                                     for category in categories}) as scores:
+            yield scores
+
+    def _scores(self, phrase, category, scores):
+        if scores is None or category not in scores:
+            scores = self._match(phrase, [category])
+        return scores[category]
+
+    @_timed("search.playlist")
+    def _search_playlist(self, phrase, scores=None):
+        utterance = self._utterance("playlist", phrase)
         if self.debug_mode:
-            logger.info("Playlist Utterance: " + str(utterance))
-        probabilities = fuzz_process.extractOne(utterance, self.playlists, scorer=fuzz.ratio)
+            logger.info("Playlist Utterance: %s", utterance)
+        probabilities = self._scores(phrase, "playlist", scores)
         if self.debug_mode:
-            logger.info("Playlist Probabilities: " + str(probabilities))
-        if probabilities[1] > 65:
+            logger.info("Playlist Probabilities: %s", probabilities)
+        if probabilities[1] > THRESHOLDS["playlist"]:
             playlist = probabilities[0]
             confidence = probabilities[1]
             return playlist, confidence
         else:
             return "Null", 0
 
-    def _search_title(self, phrase):
-        utterance = phrase + " "
-        strip_these = ["title ", "song ", "on rhythmbox ", "on rhythm box "]
-        for words in strip_these:
-            utterance = utterance.replace(words, " ")
-        utterance.lstrip()
+    @_timed("search.title")
+    def _search_title(self, phrase, scores=None):
+        utterance = self._utterance("title", phrase)
         if self.debug_mode:
-            logger.info("Title Utterance: " + str(utterance))
-        probabilities = fuzz_process.extractOne(utterance, self.titles, scorer=fuzz.ratio)
+            logger.info("Title Utterance: %s", utterance)
+        probabilities = self._scores(phrase, "title", scores)
         if self.debug_mode:
-            logger.info("Title Probabilities: " + str(probabilities))
-        if probabilities[1] > 70:
+            logger.info("Title Probabilities: %s", probabilities)
+        if probabilities[1] > THRESHOLDS["title"]:
             title = probabilities[0]
             confidence = probabilities[1]
             return title, confidence
         else:
             return "Null", 0
 
-    def _search_artist(self, phrase):
-        utterance = phrase + " "
-        strip_these = ["some ", "something ", "music ", "songs ", "tunes ", "by ", "from ", "artist ", "on rhythmbox ", "on rhythm box "]
-        for words in strip_these:
-            utterance = utterance.replace(words, " ")
-        utterance.lstrip()
+    @_timed("search.artist")
+    def _search_artist(self, phrase, scores=None):
+        utterance = self._utterance("artist", phrase)
         if self.debug_mode:
-            logger.info("Artist Utterance: " + str(utterance))
-        probabilities = fuzz_process.extractOne(utterance, self.artists, scorer=fuzz.ratio)
+            logger.info("Artist Utterance: %s", utterance)
+        probabilities = self._scores(phrase, "artist", scores)
         if self.debug_mode:
-            logger.info("Artist Probabilities: " + str(probabilities))
-        if probabilities[1] > 70:
+            logger.info("Artist Probabilities: %s", probabilities)
+        if probabilities[1] > THRESHOLDS["artist"]:
             artist = probabilities[0]
             confidence = probabilities[1]
             return artist, confidence
         else:
             return "Null", 0
 
-    def _search_album(self, phrase):
-        utterance = phrase + " "
-        strip_these = ["album ", "on rhythmbox ", "on rhythm box "]
-        for words in strip_these:
-            utterance = utterance.replace(words, " ")
-        utterance.lstrip()
+    @_timed("search.album")
+    def _search_album(self, phrase, scores=None):
+        utterance = self._utterance("album", phrase)
         if self.debug_mode:
-            logger.info("Album Utterance: " + str(utterance))
-        probabilities = fuzz_process.extractOne(utterance, self.albums, scorer=fuzz.ratio)
+            logger.info("Album Utterance: %s", utterance)
+        probabilities = self._scores(phrase, "album", scores)
         if self.debug_mode:
-            logger.info("Album Probabilities: " + str(probabilities))
-        if probabilities[1] > 70:
+            logger.info("Album Probabilities: %s", probabilities)
+        if probabilities[1] > THRESHOLDS["album"]:
             album = probabilities[0]
             confidence = probabilities[1]
             return album, confidence
         else:
             return "Null", 0
 
-    def _search_genre(self, phrase):
-        utterance = phrase + " "
-        strip_these = ["genre ", "tunes ", "some ", "songs ", "on rhythmbox ", "on rhythm box "]
-        for words in strip_these:
-            utterance = utterance.replace(words, " ")
-        utterance.lstrip()
+    @_timed("search.genre")
+    def _search_genre(self, phrase, scores=None):
+        utterance = self._utterance("genre", phrase)
         if self.debug_mode:
-            logger.info("Genre Utterance: " + str(utterance))
-        probabilities = fuzz_process.extractOne(utterance, self.genres, scorer=fuzz.ratio)
+            logger.info("Genre Utterance: %s", utterance)
+        probabilities = self._scores(phrase, "genre", scores)
         if self.debug_mode:
-            logger.info("Genre Probabilities: " + str(probabilities))
-        if probabilities[1] > 70:
+            logger.info("Genre Probabilities: %s", probabilities)
+        if probabilities[1] > THRESHOLDS["genre"]:
             genre = probabilities[0]
             confidence = probabilities[1]
             return genre, confidence
         else:
             return "Null", 0
 
-    def _search_by(self, phrase):
-        utterance = phrase
+    @_timed("search.by")
+    def _search_by(self, phrase, scores=None):
+        utterance = self._utterance("by", phrase)
         if self.debug_mode:
-            logger.info("By Utterance: " + str(utterance))
-        probabilities = fuzz_process.extractOne(utterance, self.bys, scorer=fuzz.ratio)
+            logger.info("By Utterance: %s", utterance)
+        probabilities = self._scores(phrase, "by", scores)
         if self.debug_mode:
-            logger.info("By Probabilities: " + str(probabilities))
-        if probabilities[1] > 85:
-            match = probabilities[0]
-            x = match.rfind('by')
-            title = match[:x-1]
-            artist = match[x+3:]
+            logger.info("By Probabilities: %s", probabilities)
+        if probabilities[1] > THRESHOLDS["by"]:
+            title, artist = probabilities[0]
             confidence = probabilities[1]
             return title, artist, confidence
         else:
             return "Null", "Null", 0
 
-    def _search_album_by(self, phrase):
-        if "album" in phrase:
-            utterance = phrase.replace("album", " ")
-            utterance = utterance.replace(" by ", " album by ")
-        else:
-            utterance = phrase
+    @_timed("search.album_by")
+    def _search_album_by(self, phrase, scores=None):
+        utterance = self._utterance("album_by", phrase)
         if self.debug_mode:
-            logger.info("Album By Utterance: " + str(utterance))
-        probabilities = fuzz_process.extractOne(utterance, self.album_bys, scorer=fuzz.ratio)
+            logger.info("Album By Utterance: %s", utterance)
+        probabilities = self._scores(phrase, "album_by", scores)
         if self.debug_mode:
-            logger.info("Album By Probabilities: " + str(probabilities))
-        if probabilities[1] > 85:
-            match = probabilities[0]
-            x = match.rfind('album by')
-            album = match[:x-1]
-            artist = match[x+9:]
+            logger.info("Album By Probabilities: %s", probabilities)
+        if probabilities[1] > THRESHOLDS["album_by"]:
+            album, artist = probabilities[0]
             confidence = probabilities[1]
             return album, artist, confidence
         else:
             return "Null", "Null", 0
 
+    @_timed("play.playlist")
     def _play_playlist(self, selection, confidence):
-        songs = []
-        tree = ET.parse(self.rhythmbox_playlist_xml)
-        root = tree.getroot()
-        for playlist in root.iter('playlist'):
-            name = playlist.get('name')
-            if name == selection:
-                os.system("rhythmbox-client --stop")
-                os.system("rhythmbox-client --clear-queue")
-                for location in playlist.iter('location'):
-                    x = location.text[7:]
-                    y = unquote(x)
-                    if isabs(y) == True:
-                        uri = pathlib.Path(y).as_uri()
-                        songs.append(uri)
-                if self.shuffle:
-                    random.shuffle(songs)
-                for uri in songs:
-                    song = "rhythmbox-client --enqueue {}".format(uri)
-                    os.system(song)
-                if len(songs) > 0:
-                    self.speak_dialog("selecting playlist")
-                    time.sleep(1)
-                    os.system("rhythmbox-client --play")
-                else:
-                    self.speak_dialog("Sorry, I don't know how to play that, yet")
-                    if self.debug_mode:
-                        logger.info("Cannot play relative paths.")
-            if len(songs) > 0:
-                break
+        self._play_selection("playlist", (selection,))
 
+    @_timed("play.title")
     def _play_title(self, selection, confidence):
-        tree = ET.parse(self.rhythmbox_database_xml)
-        root = tree.getroot()
-        for entry in root.iter('entry'):
-            if entry.attrib["type"] == 'song':
-                if selection == entry.find('title').text.lower():
-                    os.system("rhythmbox-client --stop")
-                    os.system("rhythmbox-client --clear-queue")
-                    x = entry.find('location').text[7:]
-                    y = unquote(x)
-                    if isabs(y) == True:
-                        uri = pathlib.Path(y).as_uri()
-                        song = "rhythmbox-client --enqueue {}".format(uri)
-                        os.system(song)
-                        os.system("rhythmbox-client --play")
-                    else:
-                        self.speak_dialog("Sorry, I don't know how to play that, yet")
-                        if self.debug_mode:
-                            logger.info("Cannot play relative paths.")
+        self._play_selection("title", (selection,))
 
+    @_timed("play.artist")
     def _play_artist(self, selection, confidence):
-        selection = selection + " "
-        strip_these = ["some ", "something ", "music ", "songs ", "tunes ", "by ", "from ", "artist ", "on rhythmbox ", "on rhythm box ", "play "]
-        for words in strip_these:
-            selection = selection.replace(words, " ")
-        os.system("rhythmbox-client --stop")
-        os.system("rhythmbox-client --clear-queue")
-        songs = []
-        tree = ET.parse(self.rhythmbox_database_xml)
-        root = tree.getroot()
-        for entry in root.iter('entry'):
-            if entry.attrib["type"] == 'song':
-                if fuzz.ratio(selection.lower(), entry.find('artist').text.lower()) > 80:
-                    x = entry.find('location').text[7:]
-                    y = unquote(x)
-                    if isabs(y) == True:
-                        uri = pathlib.Path(y).as_uri()
-                        songs.append(uri)
-        random.shuffle(songs)
-        for uri in songs:
-            song = "rhythmbox-client --enqueue {}".format(uri)
-            os.system(song)
-        if len(songs) > 0:
-            self.speak_dialog("selecting artist")
-            time.sleep(1)
-            os.system("rhythmbox-client --play")
-        else:
-            self.speak_dialog("Sorry, I don't know how to play that, yet")
-            if self.debug_mode:
-                logger.info("Cannot play relative paths.")
+        self._play_selection("artist", (selection,))
 
+    @_timed("play.album")
     def _play_album(self, selection, confidence):
-        selection = selection + " "
-        strip_these = ["album ", "on rhythmbox ", "on rhythm box ", "play "]
-        for words in strip_these:
-            selection = selection.replace(words, " ")
-        os.system("rhythmbox-client --stop")
-        os.system("rhythmbox-client --clear-queue")
-        tracks = {}
-        songs = []
-        tree = ET.parse(self.rhythmbox_database_xml)
-        root = tree.getroot()
-        for entry in root.iter('entry'):
-            if entry.attrib["type"] == 'song':
-                if fuzz.ratio(selection.lower(), entry.find('album').text.lower()) > 90:
-                    t = entry.find('track-number').text
-                    try:
-                        t = int(t)
-                    except ValueError:
-                        t = 0  
-                    x = entry.find('location').text[7:]
-                    y = unquote(x)
-                    if isabs(y) == True:
-                        uri = pathlib.Path(y).as_uri()
-                        tracks[uri] = t
-        if self.shuffle:
-            for uri, t in tracks.items():
-                songs.append(uri)
-                random.shuffle(songs)
-        else:
-            songs = sorted(tracks, key=tracks.__getitem__)
-        for uri in songs:
-            song = "rhythmbox-client --enqueue {}".format(uri)
-            os.system(song)
-        if len(songs) > 0:
-            self.speak_dialog("selecting album")
-            time.sleep(1)
-            os.system("rhythmbox-client --play")
-        else:
-            self.speak_dialog("Sorry, I don't know how to play that, yet")
-            if self.debug_mode:
-                logger.info("Cannot play relative paths.")
-     
+        self._play_selection("album", (selection,))
+
+    @_timed("play.genre")
     def _play_genre(self, selection, confidence):
-        os.system("rhythmbox-client --stop")
-        os.system("rhythmbox-client --clear-queue")
-        songs = []
-        tree = ET.parse(self.rhythmbox_database_xml)
-        root = tree.getroot()
-        for entry in root.iter('entry'):
-            if entry.attrib["type"] == 'song':
-                if fuzz.ratio(selection.lower(), entry.find('genre').text.lower()) > 80 or selection.lower() in entry.find('genre').text.lower():
-                    x = entry.find('location').text[7:]
-                    y = unquote(x)
-                    if isabs(y) == True:
-                        uri = pathlib.Path(y).as_uri()
-                        songs.append(uri)
-        random.shuffle(songs)
-        for uri in songs:
-            song = "rhythmbox-client --enqueue {}".format(uri)
-            os.system(song)
-        if len(songs) > 0:
-            self.speak_dialog("playing " + selection + " genre")
-            time.sleep(1)
-            os.system("rhythmbox-client --play")
-        else:
-            self.speak_dialog("Sorry, I don't know how to play that, yet")
-            if self.debug_mode:
-                logger.info("Cannot play relative paths.")
-   
+        self._play_selection("genre", (selection,))
+
+    @_timed("play.by")
     def _play_by(self, artist, title, confidence):
-        tree = ET.parse(self.rhythmbox_database_xml)
-        root = tree.getroot()
-        for entry in root.iter('entry'):
-            if entry.attrib["type"] == 'song':
-                if artist == entry.find('artist').text.lower():
-                    if title == entry.find('title').text.lower():
-                        os.system("rhythmbox-client --stop")
-                        os.system("rhythmbox-client --clear-queue")
-                        x = entry.find('location').text[7:]
-                        y = unquote(x)
-                        if isabs(y) == True:
-                            uri = pathlib.Path(y).as_uri()
-                            song = "rhythmbox-client --enqueue {}".format(uri)
-                            os.system(song)
-                            os.system("rhythmbox-client --play")
-                        else:
-                            self.speak_dialog("Sorry, I don't know how to play that, yet")
-                            if self.debug_mode:
-                                logger.info("Cannot play relative paths.")
+        self._play_selection("by", (artist, title))
 
+    @_timed("play.album_by")
     def _play_album_by(self, artist, album, confidence):
-        os.system("rhythmbox-client --stop")
-        os.system("rhythmbox-client --clear-queue")
-        tracks = {}
-        songs = []
-        tree = ET.parse(self.rhythmbox_database_xml)
-        root = tree.getroot()
-        for entry in root.iter('entry'):
-            if entry.attrib["type"] == 'song':
-                if artist == entry.find('artist').text.lower():
-                    if album == entry.find('album').text.lower():
-                        t = entry.find('track-number').text
-                        try:
-                            t = int(t)
-                        except ValueError:
-                            t = 0  
-                        x = entry.find('location').text[7:]
-                        y = unquote(x)
-                        if isabs(y) == True:
-                            uri = pathlib.Path(y).as_uri()
-                            tracks[uri] = t
-        if self.shuffle:
-            for uri, t in tracks.items():
-                songs.append(uri)
-                random.shuffle(songs)
+        self._play_selection("album_by", (artist, album))
+
+    def _resolve(self, library, kind, values):
+        """Track ids of a selection, before any shuffling.
+
+        None means there is nothing by that name, as opposed to a
+        selection without tracks.
+        """
+        index = library.index
+        if kind == "playlist":
+            return library.playlist_tracks(values[0])
+        if kind in ("by", "album_by"):
+            track_ids = index.lookup_pair(kind, *values)
+        elif kind == "genre":
+            selection = values[0].lower()
+            track_ids = []
+            for genre, ids in index.items('genre'):
+                if _ratio(selection, genre) > 80 or selection in genre:
+                    track_ids.extend(ids)
+            track_ids.sort()
         else:
-            songs = sorted(tracks, key=tracks.__getitem__)
-        for uri in songs:
-            song = "rhythmbox-client --enqueue {}".format(uri)
-            os.system(song)
-        if len(songs) > 0:
-            self.speak_dialog("selecting album")
-            time.sleep(1)
-            os.system("rhythmbox-client --play")
+            track_ids = index.lookup(kind, values[0])
+        if kind in ("album", "album_by"):
+            track_ids.sort(key=index.track_number)
+        return array('i', track_ids)
+
+    def _tracks(self, library, kind, values):
+        """Track ids of a selection, resolved once per library generation.
+
+        Automatic playlists may depend on the time, so they are evaluated
+        again every time.
+        """
+        if kind == "playlist" and values[0] in library.automatic_playlists:
+            return self._resolve(library, kind, values)
+        key = (kind,) + tuple(values)
+        track_ids = self.selections.get(key, library.generation)
+        if track_ids is QueryCache.MISSING:
+            track_ids = self._resolve(library, kind, values)
+            self.selections.put(key, track_ids, library.generation)
+        return track_ids
+
+    def _play_selection(self, kind, values):
+        """Play the tracks of a selection, resolving them if the match did not.
+
+        The tracks are queued by the command executor, so this returns as
+        soon as they are known.
+        """
+        library = self.library
+        track_ids = self._tracks(library, kind, values)
+        if track_ids is None:
+            return
+        if kind in ("artist", "genre") or self.shuffle:
+            track_ids = self._shuffled(library, track_ids)
+        self.commands.run("play." + kind, functools.partial(
+            self._queue_selection, library.index, kind, values, track_ids))
+
+    def _queue_selection(self, index, kind, values, track_ids):
+        self._reset_player()
+        if kind in ("title", "by"):
+            uris = index.uris(track_ids)[:1]
+            if uris:
+                self._enqueue(uris)
+                self.player.play()
+            else:
+                self._cannot_play()
+            return
+        if kind == "genre":
+            dialog = "playing " + values[0] + " genre"
         else:
-            self.speak_dialog("Sorry, I don't know how to play that, yet")
-            if self.debug_mode:
-                logger.info("Cannot play relative paths.")
+            dialog = SELECTION_DIALOGS[kind]
+        self._play_tracks(index, track_ids, dialog)
+
+    def _reset_player(self):
+        """Stop playback and empty the queue, cancelling any queue feed or window."""
+        self._cancel_feeder()
+        self.player.stop()
+        self.player.clear_queue()
+
+    def _cancel_feeder(self):
+        if self._feeder is not None:
+            self._feeder.cancel()
+            self._feeder = None
+
+    def _cannot_play(self):
+        self.speak_dialog("Sorry, I don't know how to play that, yet")
+        if self.debug_mode:
+            logger.info("No playable files: relative, unsupported or missing locations.")
+
+    def _play_tracks(self, index, track_ids, dialog):
+        """Play indexed tracks in the given order.
+
+        A selection longer than the queue_window setting is fed through a
+        QueueWindow if the player reports track changes; anything else is
+        handed to _play_songs as a list of URIs.
+        """
+        window = int(self.settings.get('queue_window', 50))
+        if window <= 0 or len(track_ids) <= window or not self.player.reports_track_changes:
+            self._play_songs(index.uris(track_ids), dialog)
+            return
+        feeder = QueueWindow(self.player, index, track_ids, window)
+        if not feeder.start():
+            self._cannot_play()
+            return
+        self._feeder = feeder
+        self.player.play()
+        self.speak_dialog(dialog)
+
+    def _play_songs(self, songs, dialog):
+        """Queue a selection of URIs and start playing it.
+
+        With streaming_playback on, playback starts as soon as the first
+        track is queued and a QueueFeeder adds the rest in the background.
+        """
+        if not songs:
+            self._cannot_play()
+            return
+        if not _is_true(self.settings.get('streaming_playback', True)):
+            self._enqueue(songs)
+            self.speak_dialog(dialog)
+            time.sleep(1)
+            self.player.play()
+            return
+        self._enqueue(songs[:1])
+        self.player.play()
+        self.speak_dialog(dialog)
+        if len(songs) > 1:
+            self._feeder = QueueFeeder(self.player, songs[1:], self._chunk_size())
+
+    def _chunk_size(self):
+        return max(1, int(self.settings.get('enqueue_chunk_size', 200)))
+
+    @_timed("enqueue")
+    def _enqueue(self, uris):
+        """Add URIs to the play queue, passing many per rhythmbox-client call."""
+        if not uris:
+            return
+        start = time.time()
+        self.player.enqueue(uris, self._chunk_size())
+        elapsed = max(time.time() - start, 1e-6)
+        logger.info("Enqueued {} tracks in {:.2f}s ({:.0f} tracks/s)".format(
+            len(uris), elapsed, len(uris) / elapsed))
+
+    def _shuffled(self, library, track_ids):
+        """Track ids in the order of the shuffle_mode setting."""
+        return library.shuffler.order(track_ids, self.settings.get('shuffle_mode', 'random'))
 
     def stop(self):
         pass
 
+    def shutdown(self):
+        if self.commands is not None:
+            self.commands.close()
+        if self._feeder is not None:
+            self._feeder.cancel()
+        if self._file_check is not None:
+            self._file_check.cancel()
+        if self._watcher is not None:
+            self._watcher.stop()
+        if self.player is not None:
+            self.player.shutdown()
+        if self.match_pool is not None:
+            self.match_pool.close()
+
 
 def create_skill():
     return RhythmboxSkill()
@@ -0,0 +1,125 @@
+"""Generate synthetic rhythmdb.xml and playlists.xml files for benchmarks.
+
+Artists are drawn from a Zipf-like distribution so a few of them own most
+of the library, names mix in non-ASCII characters, and locations include
+percent-encoded, relative and non-song (podcast, radio) entries the way a
+real Rhythmbox database does.
+
+    python benchmark/generate.py 10000 /tmp/rhythmbox-10k
+"""
+
+import argparse
+import itertools
+import os
+import random
+from urllib.parse import quote
+from xml.sax.saxutils import escape
+
+SYLLABLES = ["ka", "lo", "mi", "ra", "ven", "tor", "sel", "an", "bri", "dé",
+             "mü", "ño", "ør", "zä", "the", "ex", "qu", "ly", "on", "ja"]
+WORDS = ["love", "night", "fire", "blue", "heart", "road", "city", "dream",
+         "rain", "gold", "wild", "river", "light", "summer", "café", "naïve",
+         "señor", "straße", "two", "&", "(remastered 2011)", "live", "déjà vu"]
+GENRES = ["Rock", "Pop", "Jazz", "Blues", "Classical", "Hip-Hop", "Electronic",
+          "Rock/Pop", "Country", "Folk", "Metal", "Soul", "Reggae", "Punk Rock"]
+NON_SONGS = ["podcast-post", "iradio", "ignore"]
+
+
+def _name(rng, words):
+    return " ".join(rng.choice(WORDS) if rng.random() < 0.5 else
+                    "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 3))).title()
+                    for _ in range(words))
+
+
+def _zipf_weights(n, s=1.1):
+    return list(itertools.accumulate(1.0 / (rank ** s) for rank in range(1, n + 1)))
+
+
+def _location(artist, album, number, title, relative):
+    path = "/home/user/Music/{}/{}/{:02d} {}.mp3".format(
+        artist.replace("/", "_"), album.replace("/", "_"), number, title.replace("/", "_"))
+    if relative:
+        # Rhythmbox keeps locations it cannot resolve as relative ones
+        return "file://" + quote(path.lstrip("/"))
+    return "file://" + quote(path)
+
+
+def generate(entries, directory, seed=0, playlists=50):
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    artists = [_name(rng, rng.randint(1, 3)) for _ in range(max(10, entries // 25))]
+    artist_weights = _zipf_weights(len(artists))
+    genre_weights = _zipf_weights(len(GENRES), 0.8)
+    albums = {}
+    locations = []
+    used = set()
+    with open(os.path.join(directory, "rhythmdb.xml"), "w", encoding="utf-8") as db:
+        db.write('<?xml version="1.0" standalone="yes"?>\n<rhythmdb version="2.0">\n')
+        for i in range(entries):
+            if rng.random() < 0.03:
+                db.write('  <entry type="{}"><title>{}</title><genre></genre><artist></artist>'
+                         '<album></album><location>http://example.com/{}</location></entry>\n'
+                         .format(rng.choice(NON_SONGS), escape(_name(rng, 2)), i))
+                continue
+            artist = rng.choices(artists, cum_weights=artist_weights)[0]
+            artist_albums = albums.setdefault(artist, [])
+            if not artist_albums or rng.random() < 0.08:
+                artist_albums.append(_name(rng, rng.randint(1, 4)))
+            album = rng.choice(artist_albums)
+            title = _name(rng, rng.randint(1, 5))
+            number = rng.randint(1, 20)
+            relative = rng.random() < 0.02
+            # Rhythmbox has one entry per location; number the title of a
+            # song that would land on a location already written
+            name, copy = title, 1
+            location = _location(artist, album, number, name, relative)
+            while location in used:
+                copy += 1
+                name = "{} {}".format(title, copy)
+                location = _location(artist, album, number, name, relative)
+            title = name
+            used.add(location)
+            locations.append(location)
+            now = 1700000000
+            db.write(
+                '  <entry type="song"><title>{}</title><genre>{}</genre><artist>{}</artist>'
+                '<album>{}</album><track-number>{}</track-number><duration>{}</duration>'
+                '<file-size>{}</file-size><location>{}</location><mtime>{}</mtime>'
+                '<first-seen>{}</first-seen><last-seen>{}</last-seen><play-count>{}</play-count>'
+                '<rating>{}</rating><last-played>{}</last-played><bitrate>320</bitrate>'
+                '<date>{}</date><media-type>audio/mpeg</media-type></entry>\n'.format(
+                    escape(title), escape(rng.choices(GENRES, cum_weights=genre_weights)[0]),
+                    escape(artist), escape(album), number, rng.randint(90, 600),
+                    rng.randint(10 ** 6, 10 ** 7), escape(location), now - rng.randint(0, 10 ** 8),
+                    now - rng.randint(0, 10 ** 8), now, int(rng.expovariate(0.2)),
+                    rng.randint(0, 5), now - rng.randint(0, 10 ** 7), rng.randint(700000, 738000)))
+        db.write('</rhythmdb>\n')
+    with open(os.path.join(directory, "playlists.xml"), "w", encoding="utf-8") as pl:
+        pl.write('<?xml version="1.0"?>\n<rhythmdb-playlists>\n')
+        pl.write('  <playlist name="Play Queue" show-browser="false" browser-position="180" '
+                 'search-type="search-match" type="queue"/>\n')
+        pl.write('  <playlist name="My Top Rated" show-browser="true" browser-position="180" '
+                 'search-type="search-match" type="automatic" sort-key="Rating" sort-direction="1">'
+                 '<conjunction><equals prop="type">song</equals><greater prop="rating">4</greater>'
+                 '</conjunction></playlist>\n')
+        for _ in range(playlists):
+            pl.write('  <playlist name="{}" show-browser="true" browser-position="180" '
+                     'search-type="search-match" type="static">\n'.format(escape(_name(rng, 2))))
+            for location in rng.sample(locations, min(len(locations), rng.randint(5, 200))):
+                pl.write('    <location>{}</location>\n'.format(escape(location)))
+            pl.write('  </playlist>\n')
+        pl.write('</rhythmdb-playlists>\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("entries", type=int)
+    parser.add_argument("directory")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--playlists", type=int, default=50)
+    args = parser.parse_args()
+    generate(args.entries, args.directory, args.seed, args.playlists)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""Time the skill's index build, matching and playback paths.
+
+Runs against synthetic libraries from generate.py (created on demand)
+with a stub rhythmbox-client on the PATH, and writes the results as JSON
+so runs can be compared across versions. Needs the same environment as
+the skill itself (mycroft-core, rapidfuzz, numpy).
+
+    python benchmark/run.py --sizes 1000,10000 --output bench_output.json
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import random
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+from generate import generate
+
+SKILL_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_skill_module():
+    spec = importlib.util.spec_from_file_location(
+        "rhythmbox_skill", os.path.join(SKILL_DIR, "__init__.py"),
+        submodule_search_locations=[SKILL_DIR])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def install_stub_client(directory):
+    path = os.path.join(directory, "rhythmbox-client")
+    with open(path, "w") as f:
+        f.write("#!/bin/sh\nexit 0\n")
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    os.environ["PATH"] = directory + os.pathsep + os.environ["PATH"]
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+
+    def pick(q):
+        return samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+
+    return {"n": len(samples), "p50_ms": pick(0.50), "p99_ms": pick(0.99),
+            "max_ms": samples[-1] * 1000}
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def until_played(skill, handler):
+    """Wrap a handler so that timing it includes the player commands it queues."""
+    def wrapper(*args):
+        handler(*args)
+        skill.commands.join()
+    return wrapper
+
+
+def make_skill(module, data_dir, work_dir):
+    skill = module.RhythmboxSkill()
+    skill.rhythmbox_database_xml = os.path.join(data_dir, "rhythmdb.xml")
+    skill.rhythmbox_playlist_xml = os.path.join(data_dir, "playlists.xml")
+    skill.file_system.path = work_dir
+    skill.settings["player_backend"] = "client"
+    # The synthetic locations do not exist and would all be marked missing
+    skill.settings["file_check_rate"] = 0
+    skill.player = module.RhythmboxClientPlayer()
+    skill.commands = module.CommandExecutor(skill.player, before_stop=skill._cancel_feeder)
+    skill.speak_dialog = lambda *args, **kwargs: None
+    return skill
+
+
+def sample_utterances(library, rng, count):
+    """Requests shaped like the ones Common Play sends, plus some misses."""
+    bys = library.index.pairs('by', 'title')
+    album_bys = library.index.pairs('album_by', 'album')
+    makers = [
+        lambda: rng.choice(library.artists),
+        lambda: "something by " + rng.choice(library.artists),
+        lambda: rng.choice(library.albums),
+        lambda: rng.choice(library.titles),
+        lambda: rng.choice(library.genres),
+        lambda: rng.choice(library.playlists) + " playlist",
+        lambda: "{1} by {0}".format(*rng.choice(bys)),
+        lambda: "{1} album by {0}".format(*rng.choice(album_bys)),
+        lambda: rng.choice(library.artists) + " on rhythmbox",
+        lambda: "the sound of silence by nobody in particular",
+    ]
+    return [rng.choice(makers)() for _ in range(count)]
+
+
+def bench_size(module, size, args, rng):
+    data_dir = os.path.join(args.data_dir, "rhythmbox-{}".format(size))
+    if not os.path.exists(os.path.join(data_dir, "rhythmdb.xml")):
+        generate(size, data_dir, seed=args.seed)
+    result = {"entries": size,
+              "rhythmdb_bytes": os.path.getsize(os.path.join(data_dir, "rhythmdb.xml"))}
+    with tempfile.TemporaryDirectory() as work_dir:
+        skill = make_skill(module, data_dir, work_dir)
+        result["build_cold_s"] = timed(skill._build_cache)
+        result["build_unchanged_s"] = timed(skill._build_cache)
+        snapshot = make_skill(module, data_dir, work_dir)
+        result["snapshot_load_s"] = timed(snapshot._load_snapshot)
+        library = skill.library
+        result["tracks"] = len(library.index)
+
+        utterances = sample_utterances(library, rng, args.queries)
+        skill.query_cache.size = 0
+        result["match_uncached"] = percentiles(
+            [timed(skill.CPS_match_query_phrase, u) for u in utterances])
+        skill.query_cache.size = 256
+        result["match_cached"] = percentiles(
+            [timed(skill.CPS_match_query_phrase, u) for u in utterances])
+
+        from mycroft.messagebus.message import Message
+        shuffles = [Message("", {"utterance": rng.choice(library.albums + library.playlists)})
+                    for _ in range(args.plays)]
+        result["shuffle"] = percentiles(
+            [timed(until_played(skill, skill.handle_shuffle_rhythmbox_intent), m) for m in shuffles])
+
+        plays = {
+            "_play_title": lambda: (rng.choice(library.titles),),
+            "_play_artist": lambda: (rng.choice(library.artists),),
+            "_play_album": lambda: (rng.choice(library.albums),),
+            "_play_genre": lambda: (rng.choice(library.genres),),
+            "_play_playlist": lambda: (rng.choice(library.playlists),),
+            "_play_by": lambda: rng.choice(library.index.pairs('by', 'title')),
+            "_play_album_by": lambda: rng.choice(library.index.pairs('album_by', 'album')),
+        }
+        result["play"] = {}
+        for name, make_args in plays.items():
+            method = until_played(skill, getattr(skill, name))
+            result["play"][name] = percentiles(
+                [timed(method, *(make_args() + (100,))) for _ in range(args.plays)])
+    return result
+
+
+def git_version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"],
+                                       cwd=SKILL_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "rhythmbox-bench"))
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--plays", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_output.json")
+    args = parser.parse_args()
+
+    module = load_skill_module()
+    module.logger.setLevel("WARNING")
+    stub_dir = tempfile.mkdtemp()
+    install_stub_client(stub_dir)
+    rng = random.Random(args.seed)
+    results = {
+        "version": git_version(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "sizes": [],
+    }
+    for size in (int(s) for s in args.sizes.split(",")):
+        print("Benchmarking {} entries".format(size), file=sys.stderr)
+        results["sizes"].append(bench_size(module, size, args, rng))
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2020 Donald Falk, @gras64, Andrew Buis
+# Initial programing from Donald Falk here: https://github.com/dwfalk/rhythmbox-skill
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+"""Scoring workers of the sharded match mode, see ShardPool.
+
+The workers are started with the spawn method, and a fresh interpreter
+cannot import the skill module under the name Mycroft gave it, so this
+file is run by path and needs nothing but numpy and rapidfuzz.
+"""
+
+import numpy
+from rapidfuzz import fuzz, process as fuzz_process
+
+
+# Shards per category a ShardPool can hold; shard numbers are packed
+# below request ids in its shared arrays.
+MAX_SHARDS = 64
+
+
+def score_shard(query, choices, shard, slot, request, cancelled, perfect, block):
+    """First best (position, score) of a query in one shard of a corpus.
+
+    Scores the shard in blocks and gives up, returning None, once the
+    category is cancelled or an earlier shard has a perfect score. A
+    perfect score ends the shard and is published in ``perfect``.
+
+    Only a perfect score stops a category early. A score that merely
+    clears the cascade's thresholds could still be beaten by a later
+    choice, and the result must stay the first best one. Stopping at
+    those thresholds is left to the caller, which cancels the categories
+    it no longer needs through ``cancelled``.
+    """
+    best, best_score = 0, -1
+    for start in range(0, len(choices), block):
+        if cancelled[slot] == request:
+            return None
+        hit = perfect[slot]
+        if hit // MAX_SHARDS == request and hit % MAX_SHARDS < shard:
+            return None
+        row = numpy.rint(fuzz_process.cdist([query], choices[start:start + block],
+                                            scorer=fuzz.ratio)[0])
+        i = int(row.argmax())
+        if row[i] > best_score:
+            best, best_score = start + i, int(row[i])
+        if best_score == 100:
+            with perfect.get_lock():
+                hit = perfect[slot]
+                if hit // MAX_SHARDS != request or hit % MAX_SHARDS > shard:
+                    perfect[slot] = request * MAX_SHARDS + shard
+            break
+    return best, best_score
+
+
+def serve(connection, shard, cancelled, perfect, block):
+    """Serve scoring requests for one shard of every corpus.
+
+    Shards are loaded per library generation and the previous generation
+    is kept for requests still using it. Each reply is tagged with its
+    request and the position of its job.
+    """
+    generations = {}
+    while True:
+        message = connection.recv()
+        if message is None:
+            return
+        if message[0] == 'load':
+            _, generation, corpora = message
+            generations[generation] = corpora
+            for old in [g for g in generations if g < generation - 1]:
+                del generations[old]
+            continue
+        _, request, generation, jobs = message
+        corpora = generations.get(generation, {})
+        for position, (slot, category, query) in enumerate(jobs):
+            connection.send((request, position, score_shard(
+                query, corpora.get(category, []), shard, slot, request, cancelled, perfect, block)))
+
+
+if __name__ == '__shard_worker__':
+    # ShardPool runs this file with the arguments of serve as ARGS
+    serve(*ARGS)
@@ -0,0 +1,512 @@
+"""Tests of the skill's matching and playback against a FakePlayer.
+
+A small library is generated in a temporary directory and the skill is
+built from it the way the benchmark does, without a message bus. Needs
+the same environment as the skill itself (mycroft-core, rapidfuzz,
+numpy).
+
+    python -m pytest test
+"""
+
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from urllib.parse import quote
+from xml.sax.saxutils import escape
+
+SKILL_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NOW = int(time.time())
+
+# (artist, album, number of tracks)
+ALBUMS = [
+    ("Heart", "Greatest Hits", 60),
+    ("Simon & Garfunkel", "Bridge over Troubled Water", 6),
+    ("Beyoncé", "Lemonade", 5),
+    ("Stand By Me Band", "Covers", 4),
+    ("Fleetwood Mac", "Rumours (Remastered 2004)", 8),
+]
+
+
+def load_skill_module():
+    spec = importlib.util.spec_from_file_location(
+        "rhythmbox_skill", os.path.join(SKILL_DIR, "__init__.py"),
+        submodule_search_locations=[SKILL_DIR])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+skill_module = load_skill_module()
+skill_module.logger.setLevel("WARNING")
+
+
+def write_library(directory):
+    """Write rhythmdb.xml, playlists.xml and empty music files."""
+    entries = []
+    locations = []
+    for artist, album, count in ALBUMS:
+        for number in range(1, count + 1):
+            title = "Song {}".format(number) if artist != "Stand By Me Band" else "Go {}".format(number)
+            path = os.path.join(directory, "music", artist, album, "{:02d} {}.mp3".format(number, title))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "w").close()
+            location = "file://" + quote(path)
+            locations.append(location)
+            # Every third track was played a minute ago, the rest a year ago
+            last_played = NOW - 60 if number % 3 == 0 else NOW - 365 * 24 * 3600
+            entries.append(
+                '<entry type="song"><title>{}</title><genre>Rock</genre><artist>{}</artist>'
+                '<album>{}</album><track-number>{}</track-number><duration>200</duration>'
+                '<location>{}</location><mtime>1</mtime><play-count>{}</play-count>'
+                '<rating>{}</rating><last-played>{}</last-played></entry>'.format(
+                    escape(title), escape(artist), escape(album), number, escape(location),
+                    number, number % 6, last_played))
+    with open(os.path.join(directory, "rhythmdb.xml"), "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" standalone="yes"?>\n<rhythmdb version="2.0">\n')
+        f.write("\n".join(entries))
+        f.write('\n</rhythmdb>\n')
+    with open(os.path.join(directory, "playlists.xml"), "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0"?>\n<rhythmdb-playlists>\n')
+        f.write('<playlist name="Workout" type="static">{}</playlist>\n'.format(
+            "".join("<location>{}</location>".format(escape(l)) for l in locations[::4])))
+        f.write('<playlist name="Top Rated" type="automatic" sort-key="Rating" sort-direction="1">'
+                '<conjunction><equals prop="type">song</equals>'
+                '<greater prop="rating">4</greater></conjunction></playlist>\n')
+        f.write('<playlist name="Recently Played" type="automatic">'
+                '<conjunction><current-time-within prop="last-played">3600'
+                '</current-time-within></conjunction></playlist>\n')
+        f.write('</rhythmdb-playlists>\n')
+
+
+def setUpModule():
+    global DATA_DIR
+    DATA_DIR = tempfile.mkdtemp()
+    write_library(DATA_DIR)
+
+
+def tearDownModule():
+    shutil.rmtree(DATA_DIR, ignore_errors=True)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("Timed out waiting")
+        time.sleep(0.01)
+
+
+class SkillTestCase(unittest.TestCase):
+
+    settings = {}
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        skill = skill_module.RhythmboxSkill()
+        skill.rhythmbox_database_xml = os.path.join(DATA_DIR, "rhythmdb.xml")
+        skill.rhythmbox_playlist_xml = os.path.join(DATA_DIR, "playlists.xml")
+        skill.file_system.path = self.work_dir
+        skill.settings.update({"player_backend": "fake", "queue_window": 0, "file_check_rate": 0})
+        skill.settings.update(self.settings)
+        skill.speak_dialog = lambda *args, **kwargs: None
+        skill.player = skill_module.FakePlayer(skill.metrics)
+        skill.commands = skill_module.CommandExecutor(skill.player, skill.metrics,
+                                                      before_stop=skill._cancel_feeder)
+        skill._build_cache()
+        self.skill = skill
+
+    def tearDown(self):
+        self.skill.shutdown()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def enqueued_after(self, count):
+        return [c for c in self.skill.player.commands[count:] if c[0] == 'enqueue']
+
+
+class FakePlayerTest(SkillTestCase):
+
+    def test_commands_change_the_play_queue(self):
+        player = skill_module.FakePlayer()
+        player.enqueue(["file:///a.mp3", "file:///b.mp3"])
+        player.play()
+        self.assertEqual(player.now_playing, {'status': 'Playing',
+                                              'metadata': {'xesam:url': "file:///a.mp3"}})
+        player.pause()
+        self.assertEqual(player.now_playing['status'], 'Paused')
+        player.next()
+        self.assertEqual(player.now_playing['metadata'], {'xesam:url': "file:///b.mp3"})
+        player.next()
+        self.assertEqual(player.now_playing, {'status': 'Stopped', 'metadata': {}})
+        player.quit()
+        self.assertEqual([c[0] for c in player.commands],
+                         ['enqueue', 'play', 'pause', 'next', 'next', 'quit'])
+
+    def test_selection_is_queued_and_played(self):
+        skill = self.skill
+        skill._play_selection("artist", ("simon & garfunkel",))
+        self.assertTrue(skill.commands.join(5))
+        index = skill.library.index
+        uris = set(index.uris(index.lookup('artist', 'simon & garfunkel')))
+        player = skill.player
+        self.assertEqual(player.now_playing['status'], 'Playing')
+        self.assertEqual({player.now_playing['metadata']['xesam:url']} | set(player.queue), uris)
+        self.assertEqual(sum(c[1] for c in player.commands if c[0] == 'enqueue'), len(uris))
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_request_records_stages_and_counts(self):
+        metrics = skill_module.Metrics(enabled=True)
+        metrics.begin('match')
+        with metrics.span('score'):
+            metrics.count('processes', 2)
+        record = metrics.end()
+        self.assertEqual(record['request'], 'match')
+        self.assertEqual(record['counts'], {'processes': 2})
+        self.assertGreaterEqual(record['total_ms'], record['stages']['score'])
+        self.assertEqual(metrics.summary()['stages']['score']['n'], 1)
+
+    def test_disabled_metrics_record_nothing(self):
+        metrics = skill_module.Metrics()
+        metrics.begin('match')
+        with metrics.span('score'):
+            metrics.count('processes')
+        self.assertIsNone(metrics.end())
+        self.assertEqual(metrics.summary(), {'enabled': False, 'stages': {}, 'counts': {}})
+
+
+class StopDuringFeedTest(SkillTestCase):
+
+    settings = {"enqueue_chunk_size": 2}
+
+    def test_stop_cancels_queue_feeder(self):
+        skill = self.skill
+        skill.player.latency = 0.02
+        skill._play_selection("artist", ("heart",))
+        wait_for(lambda: len(self.enqueued_after(0)) >= 3)
+        self.assertIsInstance(skill._feeder, skill_module.QueueFeeder)
+        skill.handle_stop_rhythmbox_intent(None)
+        self.assertTrue(skill.commands.join(5))
+        count = len(skill.player.commands)
+        time.sleep(0.3)
+        self.assertEqual(skill.player.commands[count - 1], ('quit',))
+        self.assertEqual(len(skill.player.commands), count)
+        self.assertIsNone(skill._feeder)
+
+    def test_canned_stop_cancels_queue_window(self):
+        skill = self.skill
+        skill.settings["queue_window"] = 5
+        skill._play_selection("artist", ("heart",))
+        self.assertTrue(skill.commands.join(5))
+        self.assertIsInstance(skill._feeder, skill_module.QueueWindow)
+        skill.handle_canned_stop(None)
+        self.assertTrue(skill.commands.join(5))
+        self.assertIsNone(skill._feeder)
+        count = len(skill.player.commands)
+        skill.player.queue = ["file:///elsewhere.mp3"]
+        skill.player.next()
+        time.sleep(0.2)
+        self.assertEqual(self.enqueued_after(count), [])
+
+
+class QueueWindowTest(SkillTestCase):
+
+    def test_window_is_topped_up_in_order(self):
+        player = self.skill.player
+        index = self.skill.library.index
+        track_ids = index.lookup('artist', 'heart')
+        uris = list(index.uris(track_ids))
+        window = skill_module.QueueWindow(player, index, track_ids, 5)
+        self.assertTrue(window.start())
+        try:
+            wait_for(lambda: len(player.queue) == 5)
+            player.play()
+            played = [player.now_playing['metadata']['xesam:url']]
+            for _ in range(len(uris) - 1):
+                wait_for(lambda: len(player.queue) == min(5, len(uris) - len(played)))
+                player.next()
+                played.append(player.now_playing['metadata']['xesam:url'])
+            self.assertEqual(played, uris)
+            self.assertEqual(player.queue, [])
+        finally:
+            window.cancel()
+
+
+class PlaylistTest(SkillTestCase):
+
+    def test_automatic_playlists(self):
+        library = self.skill.library
+        index = library.index
+        top = library.playlist_tracks("Top Rated")
+        self.assertTrue(top)
+        self.assertTrue(all(index.columns['rating'][i] >= 4 for i in top))
+        ratings = [index.columns['rating'][i] for i in top]
+        self.assertEqual(ratings, sorted(ratings, reverse=True))
+        recent = library.playlist_tracks("Recently Played")
+        self.assertEqual(sorted(recent), sorted(i for i in index.track_ids()
+                                                if index.columns['track_number'][i] % 3 == 0))
+        playlist = library.automatic_playlists["Recently Played"]
+        self.assertEqual(playlist.tracks(now=NOW + 7200), [])
+
+    def test_automatic_playlists_are_not_cached(self):
+        library = self.skill.library
+        playlist = library.automatic_playlists["Recently Played"]
+        calls = []
+
+        def tracks(now=None):
+            calls.append(now)
+            return []
+        playlist.tracks = tracks
+        self.skill._tracks(library, "playlist", ("Recently Played",))
+        self.skill._tracks(library, "playlist", ("Recently Played",))
+        self.assertEqual(len(calls), 2)
+
+    def test_automatic_playlists_are_evaluated_at_start_only(self):
+        skill = self.skill
+        playlist = skill.library.automatic_playlists["Recently Played"]
+        calls = []
+        evaluate = playlist.tracks
+
+        def tracks(now=None):
+            calls.append(now)
+            return evaluate(now)
+        playlist.tracks = tracks
+        phrase, level, data = skill.CPS_match_query_phrase("recently played playlist")
+        skill.CPS_match_query_phrase("recently played playlist")
+        self.assertEqual(data["playlist"], "Recently Played")
+        self.assertEqual(calls, [])
+        skill.CPS_start(phrase, data)
+        self.assertEqual(len(calls), 1)
+
+
+class ShardedMatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = skill_module.ShardPool(2)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_sharded_results_match_in_process(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            skill = skill_module.RhythmboxSkill()
+            skill.rhythmbox_database_xml = os.path.join(DATA_DIR, "rhythmdb.xml")
+            skill.rhythmbox_playlist_xml = os.path.join(DATA_DIR, "playlists.xml")
+            skill.file_system.path = work_dir
+            skill.settings["file_check_rate"] = 0
+            skill._build_cache()
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        built = skill.library
+        spoken = skill_module.SpokenForms()
+        local = skill_module.Library(built.index, built.playlist_index, {}, 1, 0, None, spoken)
+        sharded = skill_module.Library(built.index, built.playlist_index, {}, 1, 0, self.pool,
+                                       skill_module.SpokenForms())
+        categories = ["genre", "playlist", "artist", "album", "title"]
+        phrases = (local.titles[:10] + local.artists + local.albums
+                   + ["song 1x", "hart", "workout", "rock music", "", "zzzz"])
+        for phrase in phrases:
+            queries = {category: skill._utterance(category, phrase) for category in categories}
+            self.assertEqual(sharded.matcher.best(queries), local.matcher.best(queries), phrase)
+        # Searches read concurrently, and closed early, route their own replies
+        errors = []
+
+        def search(phrases):
+            for phrase in phrases:
+                queries = {category: skill._utterance(category, phrase) for category in categories}
+                with sharded.matcher.search(queries) as scores:
+                    first = scores["genre"]
+                if first != local.matcher.best(queries)["genre"]:
+                    errors.append(phrase)
+        threads = [threading.Thread(target=search, args=(phrases[i::3],)) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.pool.free), self.pool.slots)
+
+
+class RequestMetricsTest(SkillTestCase):
+
+    def test_match_records_score_stage(self):
+        skill = self.skill
+        skill.metrics.enabled = True
+        records = []
+        skill.metrics.listener = records.append
+        skill.CPS_match_query_phrase("heart")
+        match = [r for r in records if r['request'] == 'match'][0]
+        self.assertIn('score', match['stages'])
+
+    def test_player_work_is_counted_in_its_request(self):
+        skill = self.skill
+        skill.metrics.enabled = True
+        records = []
+        skill.metrics.listener = records.append
+        phrase, level, data = skill.CPS_match_query_phrase("heart")
+        skill.CPS_start(phrase, data)
+        wait_for(lambda: any(r['request'] == 'start' for r in records))
+        start = [r for r in records if r['request'] == 'start'][0]
+        self.assertGreater(start['counts'].get('fake_commands', 0), 0)
+        self.assertIn('command.play.artist', start['stages'])
+
+    def test_cancelled_steps_finish_their_request(self):
+        metrics = self.skill.metrics
+        metrics.enabled = True
+        records = []
+        metrics.listener = records.append
+        executor = self.skill.commands
+        gate = threading.Event()
+        executor.run('block', gate.wait)
+        for request, command in (('next', 'next'), ('previous', 'previous')):
+            metrics.begin(request)
+            executor.submit(command)
+            metrics.end()
+        gate.set()
+        self.assertTrue(executor.join(5))
+        self.assertEqual(sorted(r['request'] for r in records), ['next', 'previous'])
+
+
+class FileCheckTest(SkillTestCase):
+
+    def test_file_check_can_be_disabled(self):
+        self.assertIsNone(self.skill._file_check)
+
+
+class CommandExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.player = skill_module.FakePlayer()
+        self.executor = skill_module.CommandExecutor(self.player)
+        self.gate = threading.Event()
+        # Hold the worker so that the following commands wait in the queue
+        self.executor.run('block', self.gate.wait)
+
+    def tearDown(self):
+        self.gate.set()
+        self.executor.close()
+
+    def run_commands(self, *commands):
+        for command in commands:
+            self.executor.submit(command)
+        self.gate.set()
+        self.assertTrue(self.executor.join(5))
+        return [c[0] for c in self.player.commands]
+
+    def test_steps_are_summed(self):
+        self.assertEqual(self.run_commands('next', 'next', 'next', 'previous'), ['next', 'next'])
+        self.assertEqual(self.executor.stats()['coalesced'], 3)
+
+    def test_opposite_steps_cancel_out(self):
+        self.assertEqual(self.run_commands('next', 'previous', 'pause'), ['pause'])
+
+    def test_repeated_commands_run_once(self):
+        self.assertEqual(self.run_commands('pause', 'pause', 'stop', 'stop'), ['pause', 'stop'])
+
+    def test_play_replaces_waiting_quit(self):
+        self.assertEqual(self.run_commands('quit', 'play'), ['play'])
+
+    def test_callables_are_not_merged(self):
+        calls = []
+        self.executor.run('play.title', lambda: calls.append(1))
+        self.executor.run('play.title', lambda: calls.append(2))
+        self.run_commands()
+        self.assertEqual(calls, [1, 2])
+
+    def test_full_queue_drops_commands(self):
+        executor = skill_module.CommandExecutor(self.player, size=2)
+        gate = threading.Event()
+        executor.run('block', gate.wait)
+        wait_for(lambda: executor.running)
+        self.assertTrue(executor.submit('pause'))
+        self.assertTrue(executor.submit('stop'))
+        self.assertFalse(executor.submit('next'))
+        gate.set()
+        executor.close()
+        self.assertEqual(executor.stats()['dropped'], 1)
+
+
+class MatchingTest(SkillTestCase):
+
+    def test_by_resolver(self):
+        scores = self.skill._match("song 3 by heart", ["by"])
+        self.assertEqual(scores["by"], (("song 3", "heart"), 100))
+        title, artist, confidence = self.skill._search_by("go 2 by stand by me band")
+        self.assertEqual((title, artist, confidence), ("go 2", "stand by me band", 100))
+
+    def test_album_by(self):
+        match = self.skill.CPS_match_query_phrase("lemonade album by beyonce")
+        self.assertEqual((match[2]["album"], match[2]["by"]), ("lemonade", "beyoncé"))
+
+    def test_phrase_grammar(self):
+        vocab = os.path.join(SKILL_DIR, "vocab")
+        grammar = skill_module.PhraseGrammar.load(os.path.join(vocab, "en-us"))
+        utterances, keywords = grammar.parse("some songs by heart on rhythmbox")
+        self.assertEqual(utterances["artist"].split(), ["heart"])
+        self.assertEqual(utterances["title"].split(), "some songs by heart".split())
+        self.assertEqual(keywords, {"general_artist", "on_rhythmbox"})
+        utterances, keywords = grammar.parse("baby one more time")
+        self.assertEqual(utterances["artist"], "baby one more time ")
+        self.assertEqual(keywords, set())
+        german = skill_module.PhraseGrammar.load(os.path.join(vocab, "de-de"),
+                                                 os.path.join(vocab, "en-us"))
+        utterances, keywords = german.parse("etwas von heart auf rhythmbox")
+        self.assertEqual(utterances["artist"].split(), ["heart"])
+        self.assertEqual(keywords, {"general_artist", "on_rhythmbox"})
+
+    def test_spoken_forms(self):
+        match = self.skill.CPS_match_query_phrase("simon and garfunkel")
+        self.assertEqual((match[2]["artist"], match[2]["confidence"]), ("simon & garfunkel", 100))
+        match = self.skill.CPS_match_query_phrase("rumours album")
+        self.assertEqual(match[2]["album"], "rumours (remastered 2004)")
+
+    def test_spoken_forms_rules(self):
+        forms = skill_module.SpokenForms()
+        self.assertEqual(forms.forms("Simon & Garfunkel"), ["simon and garfunkel"])
+        self.assertEqual(forms.forms("The Beatles"), ["beatles"])
+        self.assertIn("hey jude", forms.forms("Hey Jude (Remastered 2011)"))
+        self.assertEqual(forms.forms("1999"), ["nineteen ninety nine"])
+        self.assertEqual(forms.forms("U2"), [])
+        self.assertEqual(skill_module.SpokenForms.from_setting("article").forms("The Beatles & Co"),
+                         ["beatles   co"])
+        self.assertEqual(skill_module.SpokenForms.from_setting("").forms("The Beatles"), [])
+
+
+class TrackIndexTest(unittest.TestCase):
+
+    @staticmethod
+    def song(location, title, play_count=0):
+        return {'location': location, 'title': title, 'artist': 'Heart', 'album': 'Hits',
+                'genre': 'Rock', 'play-count': play_count}
+
+    def test_update_applies_the_delta(self):
+        index = skill_module.TrackIndex()
+        songs = [self.song("file:///{}.mp3".format(i), "Song {}".format(i)) for i in range(4)]
+        self.assertEqual(index.update(iter(songs)), (4, 0, 0))
+        songs[1] = self.song("file:///1.mp3", "Song 1", play_count=5)
+        del songs[2]
+        songs.append(self.song("file:///4.mp3", "Song 4"))
+        self.assertEqual(index.update(iter(songs)), (1, 1, 1))
+        self.assertEqual(sorted(index.names('title')), ["song 0", "song 1", "song 3", "song 4"])
+        self.assertEqual(index.columns['play_count'][index.lookup('title', "song 1")[0]], 5)
+        self.assertEqual(index.update(iter(songs)), (0, 0, 0))
+
+
+    def test_repeated_location_is_indexed_once(self):
+        index = skill_module.TrackIndex()
+        songs = [self.song("file:///a.mp3", "Song A"), self.song("file:///a.mp3", "Song B")]
+        self.assertEqual(index.update(iter(songs)), (1, 0, 0))
+        self.assertEqual(index.update(iter(songs)), (0, 0, 0))
+        self.assertEqual(index.lookup('title', "song a"), [0])
+        self.assertEqual(len(index), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()